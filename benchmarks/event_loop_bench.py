@@ -0,0 +1,75 @@
+"""
+Compares the stdlib event loop with uvloop (when installed): new TCP
+connections per second against a small echo server, and relay throughput
+of each relay engine on a plain TCP leg.
+
+Usage: python -m benchmarks.event_loop_bench [connections] [megabytes]
+"""
+import asyncio
+import sys
+import time
+from exposehost import helpers
+from exposehost.impl.relay import RELAY_ENGINES
+from benchmarks.relay_throughput_bench import run_relay
+
+CONCURRENCY = 50
+
+
+async def echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    data = await reader.read(64)
+    writer.write(data)
+    await writer.drain()
+    writer.close()
+
+
+async def run_connections(total: int) -> float:
+    server = await asyncio.start_server(echo, "127.0.0.1", 0, backlog=1024)
+    port = server.sockets[0].getsockname()[1]
+
+    async def worker(count: int):
+        for _ in range(count):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"ping")
+            await reader.read(64)
+            writer.close()
+            await writer.wait_closed()
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker(total // CONCURRENCY) for _ in range(CONCURRENCY)])
+    wall = time.perf_counter() - started
+
+    server.close()
+    await server.wait_closed()
+    return (total // CONCURRENCY) * CONCURRENCY / wall
+
+
+def run(use_uvloop: bool, coro):
+    loop = helpers.new_event_loop(use_uvloop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def main():
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    megabytes = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    total_bytes = megabytes * 1024 * 1024
+
+    loops = [("asyncio", False)]
+    if helpers.uvloop is not None:
+        loops.append(("uvloop", True))
+    else:
+        print("uvloop is not installed, only measuring the stdlib loop")
+
+    print("%-8s %-8s %10s %10s %8s" % ("loop", "engine", "conn/s", "MB/s", "CPU%"))
+    for name, use_uvloop in loops:
+        connections_per_second = run(use_uvloop, run_connections(connections))
+        for engine in RELAY_ENGINES:
+            wall, cpu = run(use_uvloop, run_relay(engine, total_bytes))
+            print("%-8s %-8s %10.0f %10.1f %8.1f" % (
+                name, engine, connections_per_second, megabytes / wall, 100 * cpu / wall))
+
+
+if __name__ == "__main__":
+    main()
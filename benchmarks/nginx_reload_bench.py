@@ -0,0 +1,115 @@
+"""
+Cost of routing http tunnels with a config file per subdomain ("files")
+versus one subdomain -> port map ("map"), at 1k and 10k subdomains.
+
+For each mode it reports the config size, the time to write the configs
+for one more tunnel, and, when nginx is installed, the time nginx takes
+to parse the whole config (nginx -t), which is what every reload pays.
+
+Usage: python -m benchmarks.nginx_reload_bench [subdomains ...]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from exposehost import helpers
+from exposehost.server.constants import DOMAIN_NAME, NGINX_ROUTING_FILES, NGINX_ROUTING_MAP
+
+KEYS_DIR = Path(__file__).resolve().parent.parent / "exposehost" / "keys"
+GENERATED_KEYS_DIR = "/home/yash/Desktop/programming/python/ExposeHost/exposehost/keys"
+
+NGINX_CONF = """pid %(prefix)s/nginx.pid;
+error_log %(prefix)s/error.log;
+events {}
+http {
+    access_log off;
+    map_hash_bucket_size 128;
+    server_names_hash_bucket_size 128;
+    server_names_hash_max_size 65536;
+    include %(config_dir)s/*.conf;
+}
+"""
+
+
+def use_config_dir(config_dir: Path):
+    helpers.NGINX_CONFIG_DIR = config_dir
+    helpers.NGINX_ROUTES_DIR = config_dir / "routes"
+    os.makedirs(config_dir, exist_ok=True)
+
+
+def fix_cert_paths(config_dir: Path):
+    # Generated configs point to the author's machine
+    for path in config_dir.glob("*.conf"):
+        path.write_text(path.read_text().replace(GENERATED_KEYS_DIR, str(KEYS_DIR)))
+
+
+def write_configs(mode: str, routes: dict[str, int]):
+    if mode == NGINX_ROUTING_MAP:
+        helpers.write_nginx_route_map("bench", routes, DOMAIN_NAME)
+    else:
+        for full_domain, port in routes.items():
+            helpers.write_nginx_config(full_domain, port)
+
+
+def config_size(config_dir: Path) -> int:
+    return sum(path.stat().st_size for path in config_dir.rglob("*") if path.is_file())
+
+
+def nginx_parse_time(nginx: str, prefix: Path) -> float:
+    started = time.perf_counter()
+    result = subprocess.run([nginx, "-t", "-q", "-p", str(prefix), "-c", str(prefix / "nginx.conf")],
+                            capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip())
+    return elapsed
+
+
+def run(mode: str, subdomains: int, nginx: str) -> tuple:
+    prefix = Path(tempfile.mkdtemp())
+    config_dir = prefix / "conf.d"
+    use_config_dir(config_dir)
+    try:
+        routes = {"tunnel%d.%s" % (i, DOMAIN_NAME): 20000 + i % 40000 for i in range(subdomains)}
+        write_configs(mode, routes)
+
+        # Adding one tunnel: a new file, or the whole map written again
+        started = time.perf_counter()
+        if mode == NGINX_ROUTING_MAP:
+            routes["new." + DOMAIN_NAME] = 19999
+            write_configs(mode, routes)
+        else:
+            write_configs(mode, {"new." + DOMAIN_NAME: 19999})
+        add_time = time.perf_counter() - started
+
+        size = config_size(config_dir)
+        parse_time = None
+        if nginx:
+            fix_cert_paths(config_dir)
+            (prefix / "nginx.conf").write_text(NGINX_CONF % {"prefix": prefix, "config_dir": config_dir})
+            parse_time = nginx_parse_time(nginx, prefix)
+        return size, add_time, parse_time
+    finally:
+        shutil.rmtree(prefix)
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000]
+    nginx = shutil.which("nginx")
+    if not nginx:
+        print("nginx is not installed, skipping the parse (reload) times")
+
+    print("%-6s %10s %12s %12s %12s" % ("mode", "subdomains", "config KiB", "add ms", "parse ms"))
+    for subdomains in counts:
+        for mode in (NGINX_ROUTING_FILES, NGINX_ROUTING_MAP):
+            size, add_time, parse_time = run(mode, subdomains, nginx)
+            print("%-6s %10d %12.0f %12.2f %12s" % (
+                mode, subdomains, size / 1024, add_time * 1000,
+                "%.1f" % (parse_time * 1000) if parse_time is not None else "-"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Micro-benchmark of the json and binary packet codecs.
+
+Packs every packet into a full frame (header + body) and unpacks it again.
+
+Usage: python -m benchmarks.packet_codec_bench [iterations]
+"""
+import sys
+import timeit
+from exposehost.impl import packets
+from exposehost.helpers import random_string
+
+
+def sample_packets():
+    tunnel_request = packets.TunnelRequestPacket()
+    tunnel_request.jwt_token = random_string(32)
+    tunnel_request.subdomain = "example"
+    tunnel_request.protocol = "http"
+    tunnel_request.c_session_key = random_string(32)
+    tunnel_request.port = 1435
+    tunnel_request.multiplex = True
+    tunnel_request.codecs = ",".join(packets.SUPPORTED_CODECS)
+
+    host_response = packets.NewConnectionHostResponsePacket()
+    host_response.connection_id = random_string(32)
+
+    pooled = packets.PooledConnectionPacket()
+    pooled.c_session_key = random_string(32)
+    pooled.max_idle = 30
+
+    loadbalance_response = packets.LoadbalanceResponsePacket()
+    loadbalance_response.new_port = 1436
+
+    tunnel_response = packets.TunnelResponsePacket()
+    tunnel_response.status = "success"
+    tunnel_response.port = 40000
+    tunnel_response.url = "https://example.exposehost.local"
+    tunnel_response.multiplex = True
+    tunnel_response.pooling = True
+
+    new_connection = packets.NewClientConnectionPacket()
+    new_connection.connection_id = random_string(32)
+    new_connection.c_session_key = random_string(32)
+
+    kill = packets.KillServerConnectionPacket()
+    kill.reason = "Connection closed during heartbeat check"
+
+    return [tunnel_request, host_response, pooled, packets.HeartBeatPacket(),
+            loadbalance_response, tunnel_response, new_connection, kill]
+
+
+def roundtrip(handler: packets.ProtocolHandler, packet: packets.Packet):
+    # Same work as ProtocolHandler.send_packet and recv_packet, minus the socket
+    packet.codec = handler.codec
+    packet.pack_data()
+    frame = handler.build_header(packet) + packet.packet_bytes
+
+    received = packets.packetList[frame[0]]()
+    received.codec = handler.codec
+    received.unpack_data(frame[5:])
+    return len(frame)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    print("%-34s %8s %12s %8s" % ("packet", "codec", "ops/s", "bytes"))
+    for packet in sample_packets():
+        for codec in (packets.CODEC_JSON, packets.CODEC_BINARY):
+            handler = packets.ProtocolHandler(None, None)
+            handler.codec = codec
+
+            size = roundtrip(handler, packet)
+            seconds = timeit.timeit(lambda: roundtrip(handler, packet), number=iterations)
+            print("%-34s %8s %12.0f %8d" % (type(packet).__name__, codec, iterations / seconds, size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Throughput benchmark of the relay engines on a plain TCP leg.
+
+A child process sends data through a relay running in this process to a
+sink it also runs, so the CPU time measured here is the relay's alone.
+
+Usage: python -m benchmarks.relay_throughput_bench [megabytes]
+"""
+import asyncio
+import multiprocessing
+import socket
+import sys
+import threading
+import time
+from exposehost.impl.relay import relay, open_socket_stream, SocketStream, RELAY_ENGINES, RELAY_ENGINE_SOCKET
+
+CHUNK = b"x" * 65536
+
+
+def source_and_sink(relay_port: int, sink_sock: socket.socket, total_bytes: int):
+    def sink():
+        conn, _ = sink_sock.accept()
+        while conn.recv(1 << 20):
+            pass
+        conn.close()
+
+    sink_thread = threading.Thread(target=sink)
+    sink_thread.start()
+
+    source = socket.create_connection(("127.0.0.1", relay_port))
+    sent = 0
+    while sent < total_bytes:
+        source.sendall(CHUNK)
+        sent += len(CHUNK)
+    source.shutdown(socket.SHUT_WR)
+    sink_thread.join()
+    source.close()
+
+
+async def run_relay(engine: str, total_bytes: int):
+    loop = asyncio.get_running_loop()
+
+    sink_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sink_sock.bind(("127.0.0.1", 0))
+    sink_sock.listen(1)
+    sink_port = sink_sock.getsockname()[1]
+
+    relay_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    relay_sock.bind(("127.0.0.1", 0))
+    relay_sock.listen(1)
+    relay_sock.setblocking(False)
+
+    process = multiprocessing.get_context("fork").Process(
+        target=source_and_sink, args=(relay_sock.getsockname()[1], sink_sock, total_bytes))
+    process.start()
+
+    if engine == RELAY_ENGINE_SOCKET:
+        client_sock, _ = await loop.sock_accept(relay_sock)
+        reader = SocketStream(client_sock)
+        writer = await open_socket_stream("127.0.0.1", sink_port)
+    else:
+        accepted = loop.create_future()
+        server = await asyncio.start_server(lambda r, w: accepted.set_result(r), sock=relay_sock)
+        reader = await accepted
+        server.close()
+        _, writer = await asyncio.open_connection("127.0.0.1", sink_port)
+
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    await relay(reader, writer)
+    writer.close()
+    await writer.wait_closed()
+    await loop.run_in_executor(None, process.join)
+
+    wall = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    sink_sock.close()
+    return wall, cpu
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    total_bytes = megabytes * 1024 * 1024
+
+    print("%-8s %10s %8s" % ("engine", "MB/s", "CPU%"))
+    for engine in RELAY_ENGINES:
+        wall, cpu = asyncio.run(run_relay(engine, total_bytes))
+        print("%-8s %10.1f %8.1f" % (engine, megabytes / wall, 100 * cpu / wall))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Micro-benchmark of AuthProxyServer.verify_session with and without the
+verified-session cache.
+
+Verifies a handful of session tokens over and over, the way the requests
+of a page load share one cookie.
+
+Usage: python -m benchmarks.session_cache_bench [iterations]
+"""
+import logging
+import sys
+import time
+from exposehost.auth_proxy import AuthProxyServer
+
+USERS = 8
+
+
+def run(cache_size: int, iterations: int):
+    proxy = AuthProxyServer({"user%s" % i: "password" for i in range(USERS)}, 0, session_cache_size=cache_size)
+    tokens = [proxy.create_session_token("user%s" % i) for i in range(USERS)]
+
+    started = time.process_time()
+    for i in range(iterations):
+        if not proxy.verify_session(tokens[i % USERS]):
+            raise RuntimeError("Session was not verified")
+    cpu = time.process_time() - started
+    return cpu, proxy.get_session_cache_stats()
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    # Per-request debug logging would dominate both runs
+    logging.disable(logging.DEBUG)
+
+    print("%-10s %12s %10s" % ("cache", "us/request", "hit rate"))
+    for name, cache_size in (("off", 0), ("on", 1024)):
+        cpu, stats = run(cache_size, iterations)
+        print("%-10s %12.2f %9.1f%%" % (name, 1e6 * cpu / iterations, 100 * stats["hit_rate"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Latency benchmark of full vs. resumed TLS handshakes between the client and
+server contexts.
+
+Opens connections one after another to a TLS listener using the server's
+context, first without offering a session, then resuming the last one.
+
+Usage: python -m benchmarks.tls_handshake_bench [connections]
+"""
+import asyncio
+import ssl
+import sys
+import time
+from exposehost.impl import tls
+from exposehost.server.server import context as server_context
+
+
+def create_client_context(resume: bool) -> ssl.SSLContext:
+    # The test certificate is self-signed
+    client_context = tls.create_client_context() if resume else ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+    return client_context
+
+
+async def run(resume: bool, connections: int):
+    async def handle(reader, writer):
+        # Sends the session ticket before the first byte
+        writer.write(b"\x01")
+        await writer.drain()
+        await reader.read()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0, ssl=server_context)
+    port = server.sockets[0].getsockname()[1]
+    client_context = create_client_context(resume)
+
+    latencies = []
+    for _ in range(connections):
+        started = time.perf_counter()
+        reader, writer = await tls.open_connection("127.0.0.1", port, client_context)
+        latencies.append(time.perf_counter() - started)
+        await reader.read(1)
+        writer.close()
+        await writer.wait_closed()
+
+    server.close()
+    await server.wait_closed()
+    latencies.sort()
+    resumed = client_context.get_stats()["resumed"] if resume else 0
+    return latencies, resumed
+
+
+def main():
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    print("%-8s %10s %10s %10s" % ("mode", "avg ms", "p99 ms", "resumed"))
+    for name, resume in (("full", False), ("resumed", True)):
+        latencies, resumed = asyncio.run(run(resume, connections))
+        print("%-8s %10.3f %10.3f %10d" % (name, 1000 * sum(latencies) / len(latencies),
+                                           1000 * latencies[int(len(latencies) * 0.99)], resumed))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,8 @@ import base64
 import hmac
 import hashlib
 import time
-from aiohttp import web, ClientSession
+from collections import OrderedDict
+from aiohttp import web, ClientSession, TCPConnector, TraceConfig, DummyCookieJar
 from exposehost.helpers import random_string
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
@@ -15,8 +16,15 @@ logger = logging.getLogger(__name__)
 # Auth cookie configuration
 AUTH_COOKIE_NAME = 'exposehost_auth_session'
 
-# Streaming configuration
-CHUNK_SIZE = 4096  # Bytes to stream per chunk
+# Connection pool to the actual service, shared by every proxied request
+POOL_LIMIT = 100                # connections open at once
+POOL_LIMIT_PER_HOST = 32        # connections open at once to the service
+POOL_KEEPALIVE_TIMEOUT = 30     # seconds an idle connection is kept
+
+# Verified session tokens remembered, so repeated requests with the same
+# cookie skip the signature check
+SESSION_CACHE_SIZE = 1024
+SESSION_CACHE_TTL = 60          # seconds before a token is verified again
 
 
 # Embedded login page HTML with CSS
@@ -173,7 +181,10 @@ class AuthProxyServer:
     """
     
     
-    def __init__(self, users: dict[str, str], actual_service_port: int):
+    def __init__(self, users: dict[str, str], actual_service_port: int,
+                 pool_limit: int = POOL_LIMIT, pool_limit_per_host: int = POOL_LIMIT_PER_HOST,
+                 pool_keepalive_timeout: float = POOL_KEEPALIVE_TIMEOUT,
+                 session_cache_size: int = SESSION_CACHE_SIZE, session_cache_ttl: float = SESSION_CACHE_TTL):
         # Users is a list of dicts: [{'username': 'u', 'password': 'p'}, ...]
         self.users = users
         self.actual_port = actual_service_port
@@ -182,6 +193,19 @@ class AuthProxyServer:
         self.runner = None
         self.site = None
         self.proxy_port = None
+
+        # Keep-alive connections to the actual service live as long as the proxy
+        self.pool_limit = pool_limit
+        self.pool_limit_per_host = pool_limit_per_host
+        self.pool_keepalive_timeout = pool_keepalive_timeout
+        self.session: ClientSession = None
+        self.pool_stats = {"requests": 0, "created": 0, "reused": 0, "queued": 0}
+
+        # token -> (username, valid until), least recently used first
+        self.session_cache: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self.session_cache_size = session_cache_size
+        self.session_cache_ttl = session_cache_ttl
+        self.session_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
         
     async def start(self) -> int:
         """Start the auth proxy server and return the port number"""
@@ -189,6 +213,8 @@ class AuthProxyServer:
         self.app.router.add_route('*', '/auth-login', self.handle_login)
         self.app.router.add_route('*', '/{path:.*}', self.handle_request)
         
+        self.session = self.create_session()
+
         self.runner = web.AppRunner(self.app)
         await self.runner.setup()
         
@@ -206,6 +232,44 @@ class AuthProxyServer:
         if self.runner:
             await self.runner.cleanup()
             logger.info("Auth proxy server stopped")
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    def create_session(self) -> ClientSession:
+        """Create the session proxied requests share, with pool statistics"""
+        trace_config = TraceConfig()
+        trace_config.on_request_start.append(self.count_pool_event("requests"))
+        trace_config.on_connection_create_end.append(self.count_pool_event("created"))
+        trace_config.on_connection_reuseconn.append(self.count_pool_event("reused"))
+        trace_config.on_connection_queued_start.append(self.count_pool_event("queued"))
+
+        connector = TCPConnector(
+            limit=self.pool_limit,
+            limit_per_host=self.pool_limit_per_host,
+            keepalive_timeout=self.pool_keepalive_timeout
+        )
+        # Cookies set by the service belong to the visitor, a shared jar
+        # would hand them to every other visitor
+        return ClientSession(
+            connector=connector,
+            cookie_jar=DummyCookieJar(),
+            trace_configs=[trace_config]
+        )
+
+    def count_pool_event(self, name: str):
+        async def on_event(session, context, params):
+            self.pool_stats[name] += 1
+        return on_event
+
+    def get_pool_stats(self) -> dict:
+        """
+        requests: requests proxied to the service
+        created: connections opened to the service
+        reused: requests sent on a kept-alive connection
+        queued: requests that waited for a free connection
+        """
+        return dict(self.pool_stats)
             
     def add_user(self, username, password):
         """Add or update a user"""
@@ -216,7 +280,38 @@ class AuthProxyServer:
         """Remove a user"""
         if username in self.users:
             del self.users[username]
+            self.invalidate_sessions(username)
             logger.info("Removed user: %s", username)
+
+    def invalidate_sessions(self, username):
+        """Drop the cached sessions of a user, they are verified again on use"""
+        tokens = [token for token, (cached_user, _) in self.session_cache.items() if cached_user == username]
+        for token in tokens:
+            del self.session_cache[token]
+        self.session_cache_stats["invalidations"] += len(tokens)
+
+    def cache_session(self, token: str, username: str, expires: float):
+        """Remember a verified token until it expires or the cache TTL runs out"""
+        if self.session_cache_size <= 0:
+            return
+        self.session_cache[token] = (username, min(expires, time.time() + self.session_cache_ttl))
+        self.session_cache.move_to_end(token)
+        while len(self.session_cache) > self.session_cache_size:
+            self.session_cache.popitem(last=False)
+            self.session_cache_stats["evictions"] += 1
+
+    def get_session_cache_stats(self) -> dict:
+        """
+        hits: requests whose session was found in the cache
+        misses: requests whose session token was verified in full
+        evictions: sessions dropped to stay within the cache size
+        invalidations: sessions dropped because their user was removed
+        """
+        stats = dict(self.session_cache_stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["size"] = len(self.session_cache)
+        return stats
     
     def create_session_token(self, username) -> str:
         """Create a signed session token"""
@@ -237,7 +332,17 @@ class AuthProxyServer:
         """Verify session token signature and expiration"""
         if not token:
             return False
-        
+
+        cached = self.session_cache.get(token)
+        if cached:
+            username, valid_until = cached
+            if valid_until > time.time() and username in self.users:
+                self.session_cache.move_to_end(token)
+                self.session_cache_stats["hits"] += 1
+                return True
+            del self.session_cache[token]
+        self.session_cache_stats["misses"] += 1
+
         try:
             parts = token.rsplit('.', 1)
             if len(parts) != 2:
@@ -270,6 +375,7 @@ class AuthProxyServer:
 
             # Log successful verification
             logger.debug("Session verified for user: %s", username)
+            self.cache_session(token, username, payload['expires'])
             return True
         except Exception as e:
             logger.error("Error verifying session token: %s", e)
@@ -345,32 +451,32 @@ class AuthProxyServer:
             service_cookies = {k: v for k, v in request.cookies.items() 
                              if k != AUTH_COOKIE_NAME}
             
-            async with ClientSession() as session:
-                # Make request to actual service
-                # aiohttp will automatically build the Cookie header from cookies dict
-                async with session.request(
-                    method=request.method,
-                    url=url,
-                    headers=headers,
-                    cookies=service_cookies,  # Built-in cookie handling
-                    data=request.content,  # Streams automatically
-                    allow_redirects=False
-                ) as resp:
-                    # Create streaming response
-                    response = web.StreamResponse(
-                        status=resp.status,
-                        reason=resp.reason,
-                        headers=resp.headers
-                    )
-                    
-                    await response.prepare(request)
-                    
-                    # Stream response body in chunks
-                    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
-                        await response.write(chunk)
-                    
-                    await response.write_eof()
-                    return response
+            # Make request to actual service
+            # aiohttp will automatically build the Cookie header from cookies dict
+            async with self.session.request(
+                method=request.method,
+                url=url,
+                headers=headers,
+                cookies=service_cookies,  # Built-in cookie handling
+                data=request.content,  # Streams automatically
+                allow_redirects=False
+            ) as resp:
+                # Create streaming response
+                response = web.StreamResponse(
+                    status=resp.status,
+                    reason=resp.reason,
+                    headers=resp.headers
+                )
+
+                await response.prepare(request)
+
+                # Stream response body as it arrives, chunks are as large
+                # as what is buffered instead of a fixed size
+                async for chunk in resp.content.iter_any():
+                    await response.write(chunk)
+
+                await response.write_eof()
+                return response
         
         except Exception as e:
             logger.error("Error proxying to service: %s", e)
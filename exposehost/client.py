@@ -1,19 +1,31 @@
 import asyncio
+import collections
 import logging
 import ssl
 import sys
-from exposehost.impl import packets
+import time
+from exposehost.impl import packets, tls
+from exposehost.impl.multiplex import Multiplexer
+from exposehost.impl.relay import (relay, open_socket_stream, RelayConfig, RELAY_ENGINE_SOCKET, MIN_BUFFER_SIZE,
+                                   MAX_BUFFER_SIZE, WRITE_HIGH_WATER, WRITE_LOW_WATER, READER_LIMIT,
+                                   SLOW_READER_PAUSE, SLOW_READER_TIMEOUT)
+from exposehost.impl.http_pool import HttpUpstreamPool, UPSTREAM_MAX_IDLE, UPSTREAM_IDLE_TIMEOUT
 from exposehost import helpers
 import threading
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Seconds the server waits for a dial-back connection, connections queued
+# at the connection limit for longer than this are dropped
+PENDING_CONNECTION_TIMEOUT = 5
+
 # Global ssl context
 # ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
 # ssl_ctx.check_hostname = False
 # ssl_ctx.verify_mode = ssl.CERT_NONE
-ssl_ctx = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH)
+# Resumes the TLS session of the server on reconnects, see tls.open_connection
+ssl_ctx = tls.create_client_context()
 ssl_ctx.check_hostname = True
 ssl_ctx.verify_mode = ssl.CERT_REQUIRED
 
@@ -38,9 +50,19 @@ class Client(packets.ProtocolHandler):
     subdomain: str = None
     status: str = 'stopped'            # stopped, connecting, connected, failed
     url: str = None
+    multiplexer: Multiplexer = None
+    pool_task: asyncio.Task = None
 
     def __init__(self, host, port, serverHost, serverPort, protocol, subdomain,
-                 auth_enabled=False, auth_users=None):
+                 auth_enabled=False, auth_users=None, multiplex=True,
+                 pool_size=4, pool_max_idle=30, max_connections=256,
+                 binary_codec=True, relay_engine=RELAY_ENGINE_SOCKET,
+                 relay_min_buffer=MIN_BUFFER_SIZE, relay_max_buffer=MAX_BUFFER_SIZE,
+                 relay_high_water=WRITE_HIGH_WATER, relay_low_water=WRITE_LOW_WATER,
+                 relay_reader_limit=READER_LIMIT, slow_reader=SLOW_READER_PAUSE,
+                 slow_reader_timeout=SLOW_READER_TIMEOUT, use_uvloop=True, http_keepalive=True,
+                 http_pool_max_idle=UPSTREAM_MAX_IDLE, http_pool_idle_timeout=UPSTREAM_IDLE_TIMEOUT,
+                 auth_pool_limit_per_host=None, auth_pool_keepalive_timeout=None):
         self.host = host
         self.actual_port = port  # Store original service port
         self.port = port
@@ -49,12 +71,59 @@ class Client(packets.ProtocolHandler):
         self.protocol = protocol
         self.subdomain = subdomain
         self.auth_proxy = None
+        # Carry tunneled connections as streams over the control connection,
+        # falls back to a new server connection per tunneled connection if
+        # the server does not support it
+        self.multiplex = multiplex
+
+        # Tunneled connections are forwarded in their own tasks, at most
+        # max_connections at a time
+        self.max_connections = max_connections
+        self.connection_slots = asyncio.Semaphore(max_connections)
+        self.connection_tasks: set[asyncio.Task] = set()
+        # Connection ids received at the limit with the time they arrived,
+        # started as slots free up so the control connection keeps being
+        # read and heartbeats answered
+        self.pending_connections: collections.deque[tuple[str, float]] = collections.deque()
+
+        # Ask the server for the binary packet codec, json otherwise
+        self.binary_codec = binary_codec
+
+        # How the plain TCP connections to the local service are relayed
+        self.relay_engine = relay_engine
+        # Relay buffers adapt to the traffic within these limits, writes to
+        # a slow local service or server are handled by slow_reader
+        self.relay_config = RelayConfig(relay_min_buffer, relay_max_buffer, relay_high_water, relay_low_water,
+                                        relay_reader_limit, slow_reader, slow_reader_timeout)
+        # Run on uvloop when it is installed, False forces the stdlib loop
+        self.use_uvloop = use_uvloop
+
+        # http tunnels are relayed request by request over keep-alive
+        # connections to the local service instead of one per tunneled connection
+        self.http_keepalive = http_keepalive
+        self.http_pool = HttpUpstreamPool(self.open_local, http_pool_max_idle, http_pool_idle_timeout)
+
+        # Idle server connections kept open for the server to hand out
+        # when multiplexing is not available
+        self.pool_size = pool_size
+        self.pool_max_idle = pool_max_idle
+        self.pool_tasks: set[asyncio.Task] = set()
+        self.pool_changed: asyncio.Event = None
+        self.pool_failures = 0
+        self.pool_stats = {"hits": 0, "misses": 0, "expired": 0}
+        self.c_session_key = None
         
         # Store auth configuration for later initialization
         if auth_enabled and protocol == 'http':
+            # Connection pool settings of the auth proxy, its defaults when None
+            pool_options = {
+                'pool_limit_per_host': auth_pool_limit_per_host,
+                'pool_keepalive_timeout': auth_pool_keepalive_timeout
+            }
             self.auth_proxy_config = {
                 'users': auth_users or {},
-                'actual_port': port
+                'actual_port': port,
+                'pool_options': {k: v for k, v in pool_options.items() if v is not None}
             }
         else:
             self.auth_proxy_config = None
@@ -78,14 +147,67 @@ class Client(packets.ProtocolHandler):
     def get_port(self):
         return self.serverPort
 
+    def get_pool_stats(self):
+        # hits: tunneled connections served by a pooled connection
+        # misses: tunneled connections the server asked us to connect back for
+        # expired: pooled connections closed after pool_max_idle seconds unused
+        stats = dict(self.pool_stats)
+        stats["idle"] = len(self.pool_tasks)
+        return stats
+
+    def get_http_pool_stats(self):
+        # requests: http requests relayed over the tunnel
+        # reused: requests sent on an idle keep-alive connection
+        # opened: connections opened to the local service
+        # retried: requests sent again after an idle connection was closed under them
+        stats = dict(self.http_pool.stats)
+        stats["idle"] = len(self.http_pool.idle)
+        return stats
+
+    def get_relay_memory_stats(self):
+        # Bytes buffered by the relays of this process, see RelayMemory
+        return self.relay_config.memory.get_stats()
+
+    def get_tls_stats(self):
+        # resumed/full: handshakes with the server that resumed a session or did a full one
+        if isinstance(ssl_ctx, tls.ResumingSSLContext):
+            return ssl_ctx.get_stats()
+        return {}
+
+    def get_active_connections(self):
+        return len(self.connection_tasks)
+
+    def spawn_connection(self, coro):
+        # Caller must hold a connection slot, released when the task is done
+        task = asyncio.create_task(coro)
+        self.connection_tasks.add(task)
+        task.add_done_callback(self.connection_task_done)
+
+    def connection_task_done(self, task: asyncio.Task):
+        self.connection_tasks.discard(task)
+        self.release_slot()
+        if not task.cancelled() and task.exception():
+            logger.error("Error occured at tunneled connection: %s", task.exception())
+
+    def release_slot(self):
+        # The slot goes straight to the next queued connection, if any
+        if not self.start_pending_connection():
+            self.connection_slots.release()
+
+    def start_pending_connection(self) -> bool:
+        # Start the oldest queued connection the server still waits for,
+        # in the slot of a connection that is done
+        while self.pending_connections:
+            connection_id, received_at = self.pending_connections.popleft()
+            if time.monotonic() - received_at < PENDING_CONNECTION_TIMEOUT:
+                self.spawn_connection(self.forward_tcp(connection_id))
+                return True
+            logger.debug("Dropping connection %s, queued for too long", connection_id)
+        return False
+
     async def forward(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         try:
-            while True:
-                data = await reader.read(4096)
-                if not data:
-                    break
-                writer.write(data)
-                await writer.drain()
+            await relay(reader, writer, self.relay_config)
         except Exception as e:
             logger.error("Error occured at forwarder: %s", e)
         finally:
@@ -94,7 +216,7 @@ class Client(packets.ProtocolHandler):
 
     async def forward_tcp(self, connection_id: str):
         # Create a connection with server
-        reader, writer = await asyncio.open_connection(self.serverHost, self.serverPort, ssl=ssl_ctx)
+        reader, writer = await tls.open_connection(self.serverHost, self.serverPort, ssl_ctx)
         new_conn_handler = packets.ProtocolHandler(reader, writer)
 
         new_conn_resp_packet = packets.NewConnectionHostResponsePacket()
@@ -107,8 +229,40 @@ class Client(packets.ProtocolHandler):
             logger.debug("Error: Server did not respond with acknowledgement.")
             return 
         
+        self.pool_stats["misses"] += 1
+        await self.forward_local(reader, writer)
+
+    async def open_local(self):
+        # New connection to the localhosted service
+        if self.relay_engine == RELAY_ENGINE_SOCKET:
+            stream = await open_socket_stream(self.host, self.port)
+            return stream, stream
+        return await asyncio.open_connection(self.host, self.port, limit=self.relay_config.reader_limit)
+
+    async def forward_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await self.http_pool.forward(reader, writer)
+        except OSError as e:
+            logger.error("Could not forward http request: %s", e)
+        except ValueError as e:
+            logger.error("Invalid http message: %s", e)
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    async def forward_local(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self.protocol == "http" and self.http_keepalive:
+            await self.forward_http(reader, writer)
+            return
+
         # After successful server connection, create localhosted service conn
-        local_reader, local_writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            local_reader, local_writer = await self.open_local()
+        except OSError as e:
+            logger.error("Could not connect to local service: %s", e)
+            writer.close()
+            await writer.wait_closed()
+            return
 
         # Forward forever
         await asyncio.gather(
@@ -116,6 +270,72 @@ class Client(packets.ProtocolHandler):
             self.forward(local_reader, writer)
         )
 
+    async def pooled_connection(self):
+        # Open an idle server connection and wait for the server to hand
+        # it a tunneled connection
+        reader, writer = await tls.open_connection(self.serverHost, self.serverPort, ssl_ctx)
+        pooled_handler = packets.ProtocolHandler(reader, writer)
+
+        pooled_packet = packets.PooledConnectionPacket()
+        pooled_packet.c_session_key = self.c_session_key
+        pooled_packet.max_idle = self.pool_max_idle
+        await pooled_handler.send_packet(pooled_packet)
+
+        # The server hands out the connection with the tunnel's codec
+        pooled_handler.codec = self.codec
+        try:
+            new_connection_packet = await asyncio.wait_for(pooled_handler.recv_packet(), self.pool_max_idle)
+            resp = await pooled_handler.recv(1)
+        except asyncio.TimeoutError:
+            self.pool_stats["expired"] += 1
+            self.pool_failures = 0
+            await pooled_handler.close()
+            return
+
+        # Handed out, no longer idle, let the pool open a replacement
+        self.pool_tasks.discard(asyncio.current_task())
+        self.pool_changed.set()
+        self.pool_failures = 0
+
+        if not isinstance(new_connection_packet, packets.NewClientConnectionPacket) or resp != b'\x01':
+            logger.debug("Error: Server did not hand out pooled connection correctly.")
+            await pooled_handler.close()
+            return
+
+        logger.debug("Connection ID: %s (pooled)", new_connection_packet.connection_id)
+        self.pool_stats["hits"] += 1
+        await self.connection_slots.acquire()
+        try:
+            await self.forward_local(reader, writer)
+        finally:
+            self.release_slot()
+
+    async def maintain_pool(self):
+        # Keep pool_size idle connections open, refilling as they get used or expire
+        self.pool_changed = asyncio.Event()
+        try:
+            while True:
+                self.pool_changed.clear()
+                if self.pool_failures:
+                    # Back off while pooled connections keep failing
+                    await asyncio.sleep(min(0.1 * 2 ** self.pool_failures, 10))
+
+                while len(self.pool_tasks) < self.pool_size:
+                    task = asyncio.create_task(self.pooled_connection())
+                    self.pool_tasks.add(task)
+                    task.add_done_callback(self.pool_task_done)
+                await self.pool_changed.wait()
+        finally:
+            for task in self.pool_tasks:
+                task.cancel()
+
+    def pool_task_done(self, task: asyncio.Task):
+        self.pool_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error("Error occured at pooled connection: %s", task.exception())
+            self.pool_failures += 1
+        self.pool_changed.set()
+
     async def server_connect(self):
         # If auth proxy is configured, start it first
         if self.auth_proxy_config:
@@ -123,7 +343,8 @@ class Client(packets.ProtocolHandler):
             
             self.auth_proxy = AuthProxyServer(
                 self.auth_proxy_config['users'],
-                self.auth_proxy_config['actual_port']
+                self.auth_proxy_config['actual_port'],
+                **self.auth_proxy_config['pool_options']
             )
             
             auth_proxy_port = await self.auth_proxy.start()
@@ -135,7 +356,7 @@ class Client(packets.ProtocolHandler):
         
         logger.info("Connecting to server %s:%s", self.serverHost, self.serverPort)
         self.status = 'connecting'
-        reader, writer = await asyncio.open_connection(self.serverHost, self.serverPort, ssl=ssl_ctx)
+        reader, writer = await tls.open_connection(self.serverHost, self.serverPort, ssl_ctx)
 
         super().__init__(reader, writer)
 
@@ -143,10 +364,15 @@ class Client(packets.ProtocolHandler):
         req_packet = packets.TunnelRequestPacket()
         
         req_packet.jwt_token = helpers.random_string(32)
-        req_packet.c_session_key = helpers.random_string(32)
+        self.c_session_key = helpers.random_string(32)
+        req_packet.c_session_key = self.c_session_key
         req_packet.port = self.serverPort
         req_packet.subdomain = self.subdomain
         req_packet.protocol = self.protocol
+        req_packet.multiplex = self.multiplex
+        req_packet.heartbeat_ack = True
+        if self.binary_codec:
+            req_packet.codecs = ",".join(packets.SUPPORTED_CODECS)
         
         await self.send_packet(req_packet)
         logger.debug("Packet info sent")
@@ -158,7 +384,7 @@ class Client(packets.ProtocolHandler):
         if isinstance(received_packet, packets.LoadbalanceResponsePacket):
             new_port = received_packet.new_port
             self.serverPort = new_port
-            reader, writer = await asyncio.open_connection(self.serverHost, new_port, ssl=ssl_ctx)
+            reader, writer = await tls.open_connection(self.serverHost, new_port, ssl_ctx)
 
             super().__init__(reader, writer)
 
@@ -179,29 +405,83 @@ class Client(packets.ProtocolHandler):
                 logger.debug("Tunnel server failed to open port, reason: %s", received_packet.error)
                 return 
 
-            while True: 
-                # Wait for new connection packet, asynchronously 
-                new_connection_packet = await self.recv_packet()
-
-                if isinstance(new_connection_packet, packets.NewClientConnectionPacket):
-                    # A new connection is received, create new server connection
-                    # and forward forever
-                    logger.info("Received new packet")
-                    logger.debug("Connection ID: %s", new_connection_packet.connection_id)
-                    await self.forward_tcp(new_connection_packet.connection_id)
-
-                if isinstance(new_connection_packet, packets.HeartBeatPacket):
-                    # logger.debug("Received heartbeat packet from server")
-                    # do nothing as packet isn't meant to do anything
-                    pass
+            # Server has switched to the codec it selected
+            self.codec = received_packet.selected_codec
+
+            if received_packet.multiplex:
+                logger.debug("Server accepted multiplexed tunnel")
+                self.multiplexer = Multiplexer(self, self.relay_config.memory)
+            elif received_packet.pooling and self.pool_size > 0:
+                logger.debug("Keeping %s pooled connections to the server", self.pool_size)
+                self.pool_task = asyncio.create_task(self.maintain_pool())
+
+            try:
+                while True: 
+                    # Wait for new connection packet, asynchronously 
+                    new_connection_packet = await self.recv_packet()
+
+                    # Frames of open streams first, only an open frame
+                    # starts a new tunneled connection
+                    if self.multiplexer and self.multiplexer.handle_packet(new_connection_packet):
+                        continue
+
+                    if isinstance(new_connection_packet, packets.StreamOpenPacket) and self.multiplexer:
+                        # New tunneled connection as a stream on this connection
+                        stream = self.multiplexer.accept_stream(new_connection_packet.stream_id)
+                        if self.connection_slots.locked():
+                            # Waiting here would also hold up the frames of
+                            # every open stream, refuse the stream instead
+                            logger.warning("Connection limit of %s reached, refusing stream", self.max_connections)
+                            stream.close()
+                            continue
+
+                        await self.connection_slots.acquire()
+                        self.spawn_connection(self.forward_local(stream, stream))
+                        continue
+
+                    if isinstance(new_connection_packet, packets.NewClientConnectionPacket):
+                        # A new connection is received, create new server connection
+                        # and forward forever
+                        logger.info("Received new packet")
+                        logger.debug("Connection ID: %s", new_connection_packet.connection_id)
+
+                        # At the connection limit the connection waits for
+                        # a free slot, reading goes on so heartbeats are
+                        # still answered
+                        if self.connection_slots.locked():
+                            self.pending_connections.append((new_connection_packet.connection_id, time.monotonic()))
+                            continue
+
+                        await self.connection_slots.acquire()
+                        self.spawn_connection(self.forward_tcp(new_connection_packet.connection_id))
+
+                    if isinstance(new_connection_packet, packets.HeartBeatPacket):
+                        # logger.debug("Received heartbeat packet from server")
+                        # Answer so the server can tell we are alive and
+                        # measure the round trip time
+                        if received_packet.heartbeat_ack:
+                            await self.send_packet(packets.HeartBeatAckPacket())
+            finally:
+                self.pending_connections.clear()
+                if self.multiplexer:
+                    self.multiplexer.close_all()
+                if self.pool_task:
+                    self.pool_task.cancel()
+                self.http_pool.close()
+
+                # Stop every tunneled connection still being forwarded
+                connection_tasks = list(self.connection_tasks)
+                for task in connection_tasks:
+                    task.cancel()
+                await asyncio.gather(*connection_tasks, return_exceptions=True)
         
     def start(self):
-        loop = asyncio.new_event_loop()
+        loop = helpers.new_event_loop(self.use_uvloop)
         loop.run_until_complete(self.server_connect())
 
     
     def start_non_blocking(self):    
-        self.loop = asyncio.new_event_loop()
+        self.loop = helpers.new_event_loop(self.use_uvloop)
 
         t = threading.Thread(target=loop_thread, args=(self.loop,), daemon=True)
         t.start()
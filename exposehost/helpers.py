@@ -1,3 +1,4 @@
+import asyncio
 import os
 from binascii import hexlify
 import re
@@ -5,9 +6,22 @@ from pathlib import Path
 import logging
 import subprocess
 
+try:
+    # Optional, faster drop-in event loop
+    import uvloop
+except ImportError:
+    uvloop = None
+
 
 HOME_DIR = Path.home()
 NGINX_CONFIG_DIR = HOME_DIR / "nginx"
+# Map routing mode, one server config for every tunnel reading the upstream
+# port from route maps, one per server process
+NGINX_MAP_CONFIG_NAME = "exposehost-routes.conf"
+NGINX_ROUTES_DIR = NGINX_CONFIG_DIR / "routes"
+# Idle connections nginx keeps open to each forwarder, so requests reuse
+# tunneled connections instead of opening one each
+NGINX_UPSTREAM_KEEPALIVE = 16
 
 
 def random_string(length: int):
@@ -19,6 +33,13 @@ def random_string(length: int):
     return r_string[0:length]
 
 
+def new_event_loop(use_uvloop: bool = True) -> asyncio.AbstractEventLoop:
+    # uvloop if it is installed and wanted, the stdlib loop otherwise
+    if use_uvloop and uvloop is not None:
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
 def clean_all_nginx_configs():
     for filename in os.listdir(NGINX_CONFIG_DIR):
         file_path = os.path.join(NGINX_CONFIG_DIR, filename)
@@ -29,13 +50,31 @@ def clean_all_nginx_configs():
             logging.error('Failed to delete %s. Reason: %s' % (file_path, e))
 
 
+def clean_nginx_route_maps():
+    # Route maps are per server process, those of processes of an earlier
+    # run that no longer exist would otherwise still be routed to
+    if not NGINX_ROUTES_DIR.is_dir():
+        return
+    for file_path in NGINX_ROUTES_DIR.iterdir():
+        try:
+            if file_path.is_file() or file_path.is_symlink():
+                file_path.unlink()
+        except Exception as e:
+            logging.error('Failed to delete %s. Reason: %s' % (file_path, e))
+
+
 def restart_nginx():
     subprocess.run("sudo /usr/bin/systemctl reload nginx", shell=True)
 
 
 def generate_nginx_http_config(full_domain: str, port: int):
     # TODO: env variables, for the ssl cert here 
-    default_config = """server {
+    default_config = """upstream example.domain.com {
+    server 127.0.0.1:9999;
+    keepalive 16;
+}
+
+server {
     listen 443 ssl;
     server_name example.domain.com;
 
@@ -44,7 +83,9 @@ def generate_nginx_http_config(full_domain: str, port: int):
     ssl_protocols TLSv1.2 TLSv1.1 TLSv1;
 
     location / {
-        proxy_pass http://0.0.0.0:9999;
+        proxy_pass http://example.domain.com;
+        proxy_http_version 1.1;
+        proxy_set_header Connection "";
         proxy_set_header Host $host;
         proxy_set_header X-Real-IP $remote_addr;
         proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
@@ -57,7 +98,9 @@ server {
     server_name example.domain.com;
 
     location / {
-        proxy_pass http://0.0.0.0:9999;
+        proxy_pass http://example.domain.com;
+        proxy_http_version 1.1;
+        proxy_set_header Connection "";
         proxy_set_header Host $host;
         proxy_set_header X-Real-IP $remote_addr;
         proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
@@ -66,14 +109,15 @@ server {
 }
     """
 
-    new_config = re.sub(r"example\.domain\.com", full_domain, default_config, 2, re.MULTILINE)
-    new_config = re.sub(r"9999", str(port), new_config, 2, re.MULTILINE)
+    new_config = re.sub(r"example\.domain\.com", full_domain, default_config, 0, re.MULTILINE)
+    new_config = re.sub(r"9999", str(port), new_config, 1, re.MULTILINE)
+    new_config = re.sub(r"keepalive 16", "keepalive %s" % NGINX_UPSTREAM_KEEPALIVE, new_config, 1, re.MULTILINE)
 
     return new_config
 
 
-def add_new_nginx_config(full_domain: str, port: int):
-    """Create a new nginx config for the domain and add it to config folder"""
+def write_nginx_config(full_domain: str, port: int):
+    """Write the nginx config of the domain to the config folder, without reloading"""
     nginx_config = generate_nginx_http_config(full_domain, port)
 
     file_name = full_domain + ".conf"
@@ -81,14 +125,103 @@ def add_new_nginx_config(full_domain: str, port: int):
 
     with open(new_config_path, "w") as f:
         f.write(nginx_config)
-    restart_nginx()
 
 
-def remove_old_nginx_config(full_domain: str):
+def delete_nginx_config(full_domain: str):
     file_name = full_domain + ".conf"
     old_config_path = NGINX_CONFIG_DIR / file_name
 
     os.unlink(old_config_path)
+
+
+def add_new_nginx_config(full_domain: str, port: int):
+    """Create a new nginx config for the domain and add it to config folder"""
+    write_nginx_config(full_domain, port)
+    restart_nginx()
+
+
+def remove_old_nginx_config(full_domain: str):
+    delete_nginx_config(full_domain)
     restart_nginx()
 
+def generate_nginx_map_config(domain_name: str):
+    # Routes *.domain_name to the upstream the route maps give for the host
+    return """include %(routes_dir)s/*.upstreams;
+
+map $host $exposehost_upstream {
+    default "";
+    include %(routes_dir)s/*.map;
+}
+
+server {
+    listen 443 ssl;
+    server_name *.%(domain_name)s;
+
+    ssl_certificate     /home/yash/Desktop/programming/python/ExposeHost/exposehost/keys/test_certificate.pem;
+    ssl_certificate_key /home/yash/Desktop/programming/python/ExposeHost/exposehost/keys/test_private_key.pem;
+    ssl_protocols TLSv1.2 TLSv1.1 TLSv1;
+
+    location / {
+        if ($exposehost_upstream = "") {
+            return 404;
+        }
+        proxy_pass http://$exposehost_upstream;
+        proxy_http_version 1.1;
+        proxy_set_header Connection "";
+        proxy_set_header Host $host;
+        proxy_set_header X-Real-IP $remote_addr;
+        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+        proxy_set_header X-Forwarded-Proto $scheme;
+    }
+}
+
+server {
+    listen 80;
+    server_name *.%(domain_name)s;
+
+    location / {
+        if ($exposehost_upstream = "") {
+            return 404;
+        }
+        proxy_pass http://$exposehost_upstream;
+        proxy_http_version 1.1;
+        proxy_set_header Connection "";
+        proxy_set_header Host $host;
+        proxy_set_header X-Real-IP $remote_addr;
+        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+        proxy_set_header X-Forwarded-Proto $scheme;
+    }
+}
+""" % {"routes_dir": NGINX_ROUTES_DIR, "domain_name": domain_name}
+
+
+def generate_nginx_route_map(routes: dict[str, int]):
+    return "".join("%s exposehost_%s;\n" % (full_domain, port) for full_domain, port in routes.items())
+
+
+def generate_nginx_route_upstreams(routes: dict[str, int]):
+    # Named upstreams, nginx only keeps connections alive to those
+    return "".join("upstream exposehost_%s {\n    server 127.0.0.1:%s;\n    keepalive %s;\n}\n"
+                   % (port, port, NGINX_UPSTREAM_KEEPALIVE) for port in sorted(set(routes.values())))
+
+
+def write_file_atomic(path: Path, content: str):
+    # nginx never sees a half written file
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def write_nginx_route_map(name: str, routes: dict[str, int], domain_name: str):
+    """Write the route map `name` and make sure the server config reading it exists"""
+    os.makedirs(NGINX_ROUTES_DIR, exist_ok=True)
+    write_file_atomic(NGINX_ROUTES_DIR / (name + ".upstreams"), generate_nginx_route_upstreams(routes))
+    write_file_atomic(NGINX_ROUTES_DIR / (name + ".map"), generate_nginx_route_map(routes))
+
+    map_config_path = NGINX_CONFIG_DIR / NGINX_MAP_CONFIG_NAME
+    map_config = generate_nginx_map_config(domain_name)
+    if not map_config_path.exists() or map_config_path.read_text() != map_config:
+        write_file_atomic(map_config_path, map_config)
+
 # print(generate_nginx_http_config("test.example.com", 5555))
\ No newline at end of file
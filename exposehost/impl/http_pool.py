@@ -0,0 +1,332 @@
+import asyncio
+import collections
+import logging
+import time
+from exposehost.impl.relay import relay
+
+logger = logging.getLogger(__name__)
+
+# Largest request/response head or chunk size line accepted
+MAX_HEAD_SIZE = 64 * 1024
+# Largest piece of a body read at once
+BODY_CHUNK_SIZE = 64 * 1024
+# Idle keep-alive connections kept to the local service, and for how long
+UPSTREAM_MAX_IDLE = 16
+UPSTREAM_IDLE_TIMEOUT = 30
+
+# How the end of a message body is found
+BODY_NONE = "none"
+BODY_LENGTH = "length"
+BODY_CHUNKED = "chunked"
+BODY_CLOSE = "close"            # body runs until the connection is closed
+
+CONTINUE_RESPONSE = b"HTTP/1.1 100 Continue\r\n\r\n"
+
+# Requests sent again when a reused connection turns out to be closed, the
+# service may have handled the first one before closing so only methods
+# without side effects qualify
+RETRY_METHODS = frozenset((b"GET", b"HEAD", b"OPTIONS", b"TRACE"))
+
+
+class HttpReader:
+    # Buffered reader over anything with read(size), used to find the
+    # boundaries of HTTP/1.1 messages
+    def __init__(self, source):
+        self.source = source
+        self.buffer = bytearray()
+        self.eof = False
+
+    async def fill(self) -> bool:
+        data = await self.source.read(BODY_CHUNK_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer.extend(data)
+        return True
+
+    async def read_until(self, separator: bytes) -> bytes:
+        # Returns None on EOF before any data
+        start = 0
+        while True:
+            index = self.buffer.find(separator, start)
+            if index >= 0:
+                end = index + len(separator)
+                data = bytes(self.buffer[:end])
+                del self.buffer[:end]
+                return data
+
+            if len(self.buffer) > MAX_HEAD_SIZE:
+                raise ValueError("HTTP head too large")
+            start = max(0, len(self.buffer) - len(separator) + 1)
+            if not await self.fill():
+                if self.buffer:
+                    raise ConnectionError("Connection closed in the middle of a message")
+                return None
+
+    async def read_some(self, size: int) -> bytes:
+        # Up to size bytes, b"" on EOF
+        if not self.buffer and not await self.fill():
+            return b""
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def is_stale(self) -> bool:
+        # An idle connection the peer has closed or sent unexpected data on
+        at_eof = getattr(self.source, "at_eof", None)
+        return self.eof or bool(self.buffer) or bool(at_eof and at_eof())
+
+
+class HttpHead:
+    # Start line and headers of a request or response
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        lines = raw[:-4].split(b"\r\n")
+        self.start_line = lines[0].split(b" ", 2)
+        if len(self.start_line) < 2:
+            raise ValueError("Malformed HTTP start line")
+        self.headers = []
+        for line in lines[1:]:
+            name, _, value = line.partition(b":")
+            self.headers.append((name.strip().lower(), value.strip()))
+
+    def get(self, name: bytes) -> bytes:
+        for header_name, value in self.headers:
+            if header_name == name:
+                return value
+        return None
+
+    def tokens(self, name: bytes) -> list[bytes]:
+        return [token.strip().lower() for header_name, value in self.headers
+                if header_name == name for token in value.split(b",")]
+
+    def without(self, name: bytes) -> bytes:
+        # Raw head with every header called name removed
+        lines = self.raw[:-4].split(b"\r\n")
+        kept = [lines[0]] + [line for line in lines[1:] if line.partition(b":")[0].strip().lower() != name]
+        return b"\r\n".join(kept) + b"\r\n\r\n"
+
+    def keep_alive(self, version: bytes) -> bool:
+        connection = self.tokens(b"connection")
+        if b"close" in connection:
+            return False
+        if version == b"HTTP/1.0":
+            return b"keep-alive" in connection
+        return True
+
+
+def body_framing(head: HttpHead, is_response: bool, request_method: bytes = None, status: int = None):
+    # Returns how the body of a message ends and its length if known
+    if is_response and (request_method == b"HEAD" or 100 <= status < 200 or status in (204, 304)):
+        return BODY_NONE, 0
+
+    transfer_encoding = head.tokens(b"transfer-encoding")
+    if transfer_encoding:
+        if transfer_encoding[-1] == b"chunked":
+            return BODY_CHUNKED, 0
+        if not is_response:
+            raise ValueError("Request body length can not be determined")
+        return BODY_CLOSE, 0
+
+    content_length = head.get(b"content-length")
+    if content_length is not None:
+        length = int(content_length)
+        if length < 0:
+            raise ValueError("Negative Content-Length")
+        return BODY_LENGTH, length
+
+    if is_response:
+        return BODY_CLOSE, 0
+    return BODY_NONE, 0
+
+
+async def copy_body(reader: HttpReader, writer, framing: str, length: int):
+    if framing == BODY_LENGTH:
+        while length:
+            data = await reader.read_some(min(length, BODY_CHUNK_SIZE))
+            if not data:
+                raise ConnectionError("Connection closed in the middle of a body")
+            writer.write(data)
+            await writer.drain()
+            length -= len(data)
+
+    elif framing == BODY_CHUNKED:
+        while True:
+            size_line = await reader.read_until(b"\r\n")
+            if size_line is None:
+                raise ConnectionError("Connection closed in the middle of a chunked body")
+            writer.write(size_line)
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                break
+            await copy_body(reader, writer, BODY_LENGTH, size + 2)   # chunk and its CRLF
+
+        # Trailers end with an empty line
+        while True:
+            line = await reader.read_until(b"\r\n")
+            if line is None:
+                raise ConnectionError("Connection closed in the middle of chunked trailers")
+            writer.write(line)
+            if line == b"\r\n":
+                break
+        await writer.drain()
+
+    elif framing == BODY_CLOSE:
+        while True:
+            data = await reader.read_some(BODY_CHUNK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+
+
+async def relay_and_close(source, destination):
+    # Closing the destination once source is done also ends the relay
+    # going the other way, its source is the same connection
+    try:
+        await relay(source, destination)
+    finally:
+        destination.close()
+
+
+class HttpUpstreamPool:
+    """
+    Keep-alive connections to the local HTTP service, shared by every
+    tunneled connection of a Client. A connection goes back to the pool
+    once a response has been fully relayed and both sides allow keep-alive.
+    """
+
+    def __init__(self, open_connection, max_idle: int = UPSTREAM_MAX_IDLE,
+                 idle_timeout: float = UPSTREAM_IDLE_TIMEOUT):
+        # async () -> reader, writer of a new connection to the local service
+        self.open_connection = open_connection
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle: collections.deque = collections.deque()
+        self.stats = {"requests": 0, "reused": 0, "opened": 0, "retried": 0}
+
+    async def acquire(self):
+        now = time.monotonic()
+        while self.idle:
+            # Most recently used first, the least likely to be closed
+            reader, writer, idle_since = self.idle.pop()
+            if now - idle_since > self.idle_timeout or writer.is_closing() or reader.is_stale():
+                writer.close()
+                continue
+            self.stats["reused"] += 1
+            return reader, writer, True
+
+        source, writer = await self.open_connection()
+        self.stats["opened"] += 1
+        return HttpReader(source), writer, False
+
+    def release(self, reader: HttpReader, writer):
+        if len(self.idle) >= self.max_idle or writer.is_closing():
+            writer.close()
+            return
+        self.idle.append((reader, writer, time.monotonic()))
+
+    def close(self):
+        while self.idle:
+            _, writer, _ = self.idle.pop()
+            writer.close()
+
+    async def send_request(self, method: bytes, head: bytes, tunnel_reader: HttpReader, framing: str, length: int):
+        # Returns reader, writer, response head of the local service
+        upstream_reader, upstream_writer, reused = await self.acquire()
+        try:
+            upstream_writer.write(head)
+            await copy_body(tunnel_reader, upstream_writer, framing, length)
+            await upstream_writer.drain()
+            raw_response = await upstream_reader.read_until(b"\r\n\r\n")
+            if raw_response is None:
+                raise ConnectionResetError("Local service closed the connection without a response")
+        except ConnectionError:
+            upstream_writer.close()
+            if not (reused and framing == BODY_NONE and method in RETRY_METHODS):
+                raise
+            # The service closed the idle connection as it was reused, safe
+            # to send again as the request had no body and no side effects
+            self.stats["retried"] += 1
+            return await self.send_request(method, head, tunnel_reader, framing, length)
+        except Exception:
+            upstream_writer.close()
+            raise
+        return upstream_reader, upstream_writer, HttpHead(raw_response)
+
+    async def forward(self, reader, writer):
+        # Relay HTTP/1.1 requests from a tunneled connection to pooled
+        # connections to the local service, one request at a time
+        tunnel_reader = HttpReader(reader)
+        while True:
+            raw_request = await tunnel_reader.read_until(b"\r\n\r\n")
+            if raw_request is None:
+                return
+
+            request = HttpHead(raw_request)
+            method = request.start_line[0]
+            request_version = request.start_line[2] if len(request.start_line) > 2 else b"HTTP/1.0"
+            framing, length = body_framing(request, is_response=False)
+            self.stats["requests"] += 1
+
+            head = raw_request
+            if b"100-continue" in request.tokens(b"expect"):
+                # Let the visitor send the body right away, it is relayed
+                # before the response is read anyway
+                writer.write(CONTINUE_RESPONSE)
+                await writer.drain()
+                head = request.without(b"expect")
+
+            upstream_reader, upstream_writer, response = await self.send_request(
+                method, head, tunnel_reader, framing, length)
+            status = int(response.start_line[1])
+            while 100 <= status < 200 and status != 101:
+                # Interim responses are passed on as they are
+                writer.write(response.raw)
+                raw_response = await upstream_reader.read_until(b"\r\n\r\n")
+                if raw_response is None:
+                    upstream_writer.close()
+                    raise ConnectionError("Local service closed the connection without a response")
+                response = HttpHead(raw_response)
+                status = int(response.start_line[1])
+
+            writer.write(response.raw)
+            if status == 101:
+                # Protocol switch (websockets), relay raw from now on
+                await writer.drain()
+                await self.switch_protocols(tunnel_reader, writer, upstream_reader, upstream_writer)
+                return
+
+            response_framing, response_length = body_framing(response, True, method, status)
+            try:
+                await copy_body(upstream_reader, writer, response_framing, response_length)
+                await writer.drain()
+            except Exception:
+                upstream_writer.close()
+                raise
+
+            response_keep_alive = response_framing != BODY_CLOSE and response.keep_alive(response.start_line[0])
+            if response_keep_alive:
+                self.release(upstream_reader, upstream_writer)
+            else:
+                upstream_writer.close()
+
+            if not (response_keep_alive and request.keep_alive(request_version)):
+                return
+
+    async def switch_protocols(self, tunnel_reader: HttpReader, writer, upstream_reader: HttpReader, upstream_writer):
+        try:
+            # Bytes already read past the heads belong to the new protocol
+            if upstream_reader.buffer:
+                writer.write(bytes(upstream_reader.buffer))
+                await writer.drain()
+            if tunnel_reader.buffer:
+                upstream_writer.write(bytes(tunnel_reader.buffer))
+                await upstream_writer.drain()
+            await asyncio.gather(
+                relay_and_close(tunnel_reader.source, upstream_writer),
+                relay_and_close(upstream_reader.source, writer)
+            )
+        finally:
+            upstream_writer.close()
+
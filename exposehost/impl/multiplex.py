@@ -0,0 +1,224 @@
+import asyncio
+import logging
+from exposehost.impl import packets
+from exposehost.impl.relay import RelayMemory, DEFAULT_RELAY_MEMORY
+
+logger = logging.getLogger(__name__)
+
+# Bytes a peer may send on a stream before waiting for a window update
+STREAM_WINDOW_SIZE = 256 * 1024
+# Largest payload carried by a single StreamDataPacket
+MAX_FRAME_SIZE = 16 * 1024
+
+
+class MuxStream:
+    """
+    A logical connection carried over the control connection of a tunnel.
+    Implements the parts of StreamReader/StreamWriter used by the forwarders,
+    so the same object is passed as both reader and writer.
+    """
+    # write() copies into send_buffer, callers may reuse their buffer
+    accepts_views = True
+
+    def __init__(self, multiplexer, stream_id: int):
+        self.multiplexer = multiplexer
+        self.stream_id = stream_id
+
+        self.recv_buffer = bytearray()
+        self.recv_event = asyncio.Event()
+        self.unacked_bytes = 0              # bytes read but not yet granted back to the peer
+
+        self.send_buffer = bytearray()
+        self.send_window = STREAM_WINDOW_SIZE
+        self.window_event = asyncio.Event()
+
+        self.closed = False                 # closed locally
+        self.remote_closed = False          # closed by the peer
+        self.close_task: asyncio.Task = None
+
+    def feed_data(self, data: bytes):
+        if self.closed:
+            return
+        # Bytes received but not granted back yet may never exceed the
+        # window, a peer sending past it is reset
+        if len(self.recv_buffer) + self.unacked_bytes + len(data) > STREAM_WINDOW_SIZE:
+            logger.warning("Stream %s sent past its window, resetting it", self.stream_id)
+            self.multiplexer.stats["window_violations"] += 1
+            self.close()
+            return
+        self.recv_buffer.extend(data)
+        self.multiplexer.memory.streams += len(data)
+        self.recv_event.set()
+
+    def take(self, size: int) -> bytes:
+        data = bytes(self.recv_buffer[:size])
+        del self.recv_buffer[:size]
+        self.multiplexer.memory.streams -= len(data)
+        return data
+
+    def feed_close(self):
+        self.remote_closed = True
+        self.recv_event.set()
+        self.window_event.set()
+
+    def add_window(self, increment: int):
+        self.send_window += increment
+        self.window_event.set()
+
+    async def wait_data(self) -> bool:
+        # Wait until data is buffered, returns False on EOF
+        while not self.recv_buffer:
+            if self.closed or self.remote_closed:
+                return False
+            self.recv_event.clear()
+            await self.recv_event.wait()
+        return True
+
+    async def consumed(self, size: int):
+        # Grant the consumed bytes back to the sender once half the window is used
+        self.unacked_bytes += size
+        if self.unacked_bytes >= STREAM_WINDOW_SIZE // 2 and not self.remote_closed:
+            increment = self.unacked_bytes
+            self.unacked_bytes = 0
+            await self.multiplexer.send_window_update(self.stream_id, increment)
+
+    async def read(self, size: int = -1) -> bytes:
+        if not await self.wait_data():
+            return b""
+
+        if size < 0:
+            size = len(self.recv_buffer)
+        data = self.take(size)
+        await self.consumed(len(data))
+        return data
+
+    async def recv_into(self, buffer) -> int:
+        # Same as read(), but copies into the caller's buffer
+        if not await self.wait_data():
+            return 0
+
+        size = min(len(buffer), len(self.recv_buffer))
+        buffer[:size] = self.take(size)
+        await self.consumed(size)
+        return size
+
+    def write(self, data: bytes):
+        self.send_buffer.extend(data)
+
+    async def drain(self):
+        while self.send_buffer:
+            if self.closed or self.remote_closed:
+                raise ConnectionResetError("Stream %s is closed" % self.stream_id)
+
+            if self.send_window <= 0:
+                # Wait for the peer to read some data
+                self.window_event.clear()
+                await self.window_event.wait()
+                continue
+
+            size = min(len(self.send_buffer), self.send_window, MAX_FRAME_SIZE)
+            chunk = bytes(self.send_buffer[:size])
+            del self.send_buffer[:size]
+            self.send_window -= size
+
+            if not await self.multiplexer.send_data(self.stream_id, chunk):
+                raise ConnectionResetError("Control connection is closed")
+
+    def is_closing(self) -> bool:
+        return self.closed or self.remote_closed
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # Unread data is dropped
+        self.take(len(self.recv_buffer))
+        # Wake up the read and drain side
+        self.recv_event.set()
+        self.window_event.set()
+        self.close_task = asyncio.ensure_future(self.multiplexer.close_stream(self))
+
+    async def wait_closed(self):
+        if self.close_task:
+            await self.close_task
+
+
+class Multiplexer:
+    """
+    Carries many MuxStreams over one ProtocolHandler connection using the
+    Stream* packets. Only the server opens streams, the client accepts them.
+    Data received on the streams is accounted in memory.
+    """
+
+    def __init__(self, handler: packets.ProtocolHandler, memory: RelayMemory = DEFAULT_RELAY_MEMORY):
+        self.handler = handler
+        self.memory = memory
+        self.streams: dict[int, MuxStream] = {}
+        self.next_stream_id = 1
+        self.stats = {"window_violations": 0}
+
+    async def open_stream(self) -> MuxStream:
+        stream_id = self.next_stream_id
+        self.next_stream_id += 1
+        stream = self.accept_stream(stream_id)
+
+        open_packet = packets.StreamOpenPacket()
+        open_packet.stream_id = stream_id
+        if not await self.handler.send_packet(open_packet):
+            self.streams.pop(stream_id, None)
+            stream.feed_close()
+        return stream
+
+    def accept_stream(self, stream_id: int) -> MuxStream:
+        stream = MuxStream(self, stream_id)
+        self.streams[stream_id] = stream
+        return stream
+
+    def handle_packet(self, packet: packets.Packet) -> bool:
+        # Dispatch a received stream frame, returns False for any other packet
+        if isinstance(packet, packets.StreamDataPacket):
+            stream = self.streams.get(packet.stream_id)
+            if stream:
+                stream.feed_data(packet.data)
+            return True
+
+        if isinstance(packet, packets.StreamWindowUpdatePacket):
+            stream = self.streams.get(packet.stream_id)
+            if stream:
+                stream.add_window(packet.increment)
+            return True
+
+        if isinstance(packet, packets.StreamClosePacket):
+            stream = self.streams.pop(packet.stream_id, None)
+            if stream:
+                stream.feed_close()
+            return True
+
+        return False
+
+    async def send_data(self, stream_id: int, data: bytes) -> bool:
+        data_packet = packets.StreamDataPacket()
+        data_packet.stream_id = stream_id
+        data_packet.data = data
+        return await self.handler.send_packet(data_packet)
+
+    async def send_window_update(self, stream_id: int, increment: int) -> bool:
+        window_packet = packets.StreamWindowUpdatePacket()
+        window_packet.stream_id = stream_id
+        window_packet.increment = increment
+        return await self.handler.send_packet(window_packet)
+
+    async def close_stream(self, stream: MuxStream):
+        self.streams.pop(stream.stream_id, None)
+        if stream.remote_closed:
+            return
+
+        close_packet = packets.StreamClosePacket()
+        close_packet.stream_id = stream.stream_id
+        await self.handler.send_packet(close_packet)
+
+    def close_all(self):
+        # Control connection is gone, end every stream
+        for stream in self.streams.values():
+            stream.feed_close()
+        self.streams.clear()
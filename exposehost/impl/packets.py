@@ -1,12 +1,91 @@
 import asyncio
 import json
 import logging     
+import struct
+
+# Packet body encodings, negotiated when the tunnel is set up. Every
+# connection starts with json so older peers keep working
+CODEC_JSON = "json"
+CODEC_BINARY = "binary"
+SUPPORTED_CODECS = (CODEC_BINARY, CODEC_JSON)
+
+# Bodies up to this length are not sent, json has 2 bytes of {}
+EMPTY_BODY_LENGTH = {
+    CODEC_JSON: 2,
+    CODEC_BINARY: 0,
+}
+
+# Fixed width fields of the binary codec, strings are prefixed with a u16
+# length, NULL_STRING_LENGTH marks a None string
+BINARY_FIELDS = {
+    "u8": struct.Struct("!B"),
+    "u16": struct.Struct("!H"),
+    "u32": struct.Struct("!I"),
+    "bool": struct.Struct("!?"),
+}
+STRING_LENGTH = struct.Struct("!H")
+NULL_STRING_LENGTH = 0xFFFF
+
 
 class Packet:
     packet_id: int = None
     packet_length: int = None
     packet_json: dict = None
     packet_bytes: bytes = None
+    codec: str = CODEC_JSON
+    # (field name, field type) pairs of packet_json, in binary codec order
+    binary_layout: tuple = ()
+
+    def serialize_bytes(self):
+        if self.codec == CODEC_BINARY:
+            return self.serialize_binary_bytes()
+        return self.serialize_json_bytes()
+
+    def deserialize_bytes(self):
+        if self.codec == CODEC_BINARY:
+            return self.deserialize_binary_bytes()
+        return self.deserialize_json_bytes()
+
+    def serialize_binary_bytes(self):
+        parts = []
+        for name, field_type in self.binary_layout:
+            value = self.packet_json.get(name)
+            if field_type == "str":
+                if value is None:
+                    parts.append(STRING_LENGTH.pack(NULL_STRING_LENGTH))
+                    continue
+                encoded = value.encode()
+                parts.append(STRING_LENGTH.pack(len(encoded)))
+                parts.append(encoded)
+            else:
+                parts.append(BINARY_FIELDS[field_type].pack(value or 0))
+
+        self.packet_bytes = b"".join(parts)
+        self.packet_length = len(self.packet_bytes)
+        return self.packet_bytes
+
+    def deserialize_binary_bytes(self):
+        buffer = self.packet_bytes or b""
+        self.packet_length = len(buffer)
+
+        packet_json = {}
+        offset = 0
+        for name, field_type in self.binary_layout:
+            if field_type == "str":
+                (length,) = STRING_LENGTH.unpack_from(buffer, offset)
+                offset += STRING_LENGTH.size
+                if length == NULL_STRING_LENGTH:
+                    packet_json[name] = None
+                    continue
+                packet_json[name] = buffer[offset:offset + length].decode()
+                offset += length
+            else:
+                field = BINARY_FIELDS[field_type]
+                (packet_json[name],) = field.unpack_from(buffer, offset)
+                offset += field.size
+
+        self.packet_json = packet_json
+        return packet_json
 
     def serialize_json_bytes(self):
         serialized_data = json.dumps(self.packet_json)
@@ -36,6 +115,19 @@ class TunnelRequestPacket(Packet):
     protocol: str = None
     c_session_key: str = None
     port: int = None
+    multiplex: bool = False
+    codecs: str = CODEC_JSON                   # comma separated, preferred first
+    heartbeat_ack: bool = False                # client answers heartbeats
+    binary_layout = (
+        ("jwt_token", "str"),
+        ("subdomain", "str"),
+        ("protocol", "str"),
+        ("c_session_key", "str"),
+        ("port", "u16"),
+        ("multiplex", "bool"),
+        ("codecs", "str"),
+        ("heartbeat_ack", "bool"),
+    )
 
     def pack_data(self) -> int:
         # Pack the packet and return the header bytes
@@ -44,26 +136,36 @@ class TunnelRequestPacket(Packet):
             "subdomain": self.subdomain,
             "protocol": self.protocol,
             "c_session_key": self.c_session_key,
-            "port": self.port
+            "port": self.port,
+            "multiplex": self.multiplex,
+            "codecs": self.codecs,
+            "heartbeat_ack": self.heartbeat_ack
         }
         
-        self.serialize_json_bytes()
+        self.serialize_bytes()
         return self.packet_length
     
     def unpack_data(self, buffer: bytes):
         self.packet_bytes = buffer
-        packet_json = self.deserialize_json_bytes()
+        packet_json = self.deserialize_bytes()
 
         self.jwt_token = packet_json['jwt_token']
         self.subdomain = packet_json['subdomain']
         self.protocol = packet_json['protocol']
         self.c_session_key = packet_json['c_session_key']
         self.port = packet_json['port']
+        # Older clients do not send this field
+        self.multiplex = packet_json.get('multiplex', False)
+        self.codecs = packet_json.get('codecs') or CODEC_JSON
+        self.heartbeat_ack = packet_json.get('heartbeat_ack', False)
 
 
 class NewConnectionHostResponsePacket(Packet):
     packet_id = 2
     connection_id: str = None
+    binary_layout = (
+        ("connection_id", "str"),
+    )
 
     def pack_data(self) -> int:
         # Pack the packet and return the packet length
@@ -71,16 +173,46 @@ class NewConnectionHostResponsePacket(Packet):
             "connection_id": self.connection_id,
         }
 
-        self.serialize_json_bytes()
+        self.serialize_bytes()
         return self.packet_length
     
     def unpack_data(self, buffer: bytes):
         self.packet_bytes = buffer
-        packet_json = self.deserialize_json_bytes()
+        packet_json = self.deserialize_bytes()
 
         self.connection_id = packet_json['connection_id']
 
 
+class PooledConnectionPacket(Packet):
+    # Sent by the client on an idle connection it keeps open for future
+    # tunneled connections, the server hands it out instead of asking for
+    # a new connection
+    packet_id = 3
+    c_session_key: str = None
+    max_idle: int = None
+    binary_layout = (
+        ("c_session_key", "str"),
+        ("max_idle", "u32"),
+    )
+
+    def pack_data(self) -> int:
+        # Pack the packet and return the packet length
+        self.packet_json = {
+            "c_session_key": self.c_session_key,
+            "max_idle": self.max_idle
+        }
+
+        self.serialize_bytes()
+        return self.packet_length
+
+    def unpack_data(self, buffer: bytes):
+        self.packet_bytes = buffer
+        packet_json = self.deserialize_bytes()
+
+        self.c_session_key = packet_json['c_session_key']
+        self.max_idle = packet_json['max_idle']
+
+
 class HeartBeatPacket(Packet):
     packet_id = 200
 
@@ -89,7 +221,7 @@ class HeartBeatPacket(Packet):
         self.packet_json = {
         }
 
-        self.serialize_json_bytes()
+        self.serialize_bytes()
         return self.packet_length
     
     def unpack_data(self, buffer: bytes):
@@ -97,9 +229,30 @@ class HeartBeatPacket(Packet):
         packet_json = {}
 
 
+class HeartBeatAckPacket(Packet):
+    # Answer to a HeartBeatPacket, only sent when the server asked for it
+    # in the TunnelResponsePacket
+    packet_id = 202
+
+    def pack_data(self) -> int:
+        # Pack the packet and return the packet length
+        self.packet_json = {
+        }
+
+        self.serialize_bytes()
+        return self.packet_length
+
+    def unpack_data(self, buffer: bytes):
+        self.packet_bytes = buffer
+        packet_json = {}
+
+
 class LoadbalanceResponsePacket(Packet):
     packet_id = 201
     new_port: int = None
+    binary_layout = (
+        ("new_port", "u16"),
+    )
 
     def pack_data(self) -> int:
         # Pack the packet and return the packet length
@@ -107,12 +260,12 @@ class LoadbalanceResponsePacket(Packet):
             "new_port": self.new_port
         }
 
-        self.serialize_json_bytes()
+        self.serialize_bytes()
         return self.packet_length
     
     def unpack_data(self, buffer: bytes):
         self.packet_bytes = buffer
-        packet_json = self.deserialize_json_bytes()
+        packet_json = self.deserialize_bytes()
 
         self.new_port = packet_json["new_port"]
 
@@ -123,6 +276,20 @@ class TunnelResponsePacket(Packet):
     status: str = None
     error: str = None
     url: str = ""
+    multiplex: bool = False
+    pooling: bool = False
+    selected_codec: str = CODEC_JSON           # codec used after this packet
+    heartbeat_ack: bool = False                # server wants heartbeats answered
+    binary_layout = (
+        ("status", "str"),
+        ("port", "u16"),
+        ("url", "str"),
+        ("error", "str"),
+        ("multiplex", "bool"),
+        ("pooling", "bool"),
+        ("codec", "str"),
+        ("heartbeat_ack", "bool"),
+    )
 
     def pack_data(self) -> int:
         # Pack the packet and return the packet length
@@ -130,24 +297,33 @@ class TunnelResponsePacket(Packet):
             self.packet_json = {
                 "status": "success",
                 "port": self.port,
-                "url": self.url
+                "url": self.url,
+                "multiplex": self.multiplex,
+                "pooling": self.pooling,
+                "codec": self.selected_codec,
+                "heartbeat_ack": self.heartbeat_ack
             }
         else:
             self.packet_json = {
                 "status": "error",
                 "error": self.error
             }
-        self.serialize_json_bytes()
+        self.serialize_bytes()
         return self.packet_length
     
     def unpack_data(self, buffer: bytes):
         self.packet_bytes = buffer
-        packet_json = self.deserialize_json_bytes()
+        packet_json = self.deserialize_bytes()
 
         self.status = packet_json['status']
         if self.status == "success":
             self.port = packet_json["port"]
             self.url = packet_json["url"]
+            # Older servers do not send this field
+            self.multiplex = packet_json.get("multiplex", False)
+            self.pooling = packet_json.get("pooling", False)
+            self.selected_codec = packet_json.get("codec") or CODEC_JSON
+            self.heartbeat_ack = packet_json.get("heartbeat_ack", False)
         else:
             self.error = packet_json["error"]
 
@@ -156,6 +332,10 @@ class NewClientConnectionPacket(Packet):
     packet_id = 101
     connection_id: str = None
     c_session_key: str = None
+    binary_layout = (
+        ("connection_id", "str"),
+        ("c_session_key", "str"),
+    )
 
     def pack_data(self) -> int:
         # Pack the packet and return the packet length
@@ -164,12 +344,12 @@ class NewClientConnectionPacket(Packet):
             "c_session_key": self.c_session_key
         }
 
-        self.serialize_json_bytes()
+        self.serialize_bytes()
         return self.packet_length
     
     def unpack_data(self, buffer: bytes):
         self.packet_bytes = buffer
-        packet_json = self.deserialize_json_bytes()
+        packet_json = self.deserialize_bytes()
 
         self.connection_id = packet_json['connection_id']
         self.c_session_key = packet_json['c_session_key']
@@ -178,6 +358,9 @@ class NewClientConnectionPacket(Packet):
 class KillServerConnectionPacket(Packet):
     packet_id = 255
     reason: str = ""
+    binary_layout = (
+        ("reason", "str"),
+    )
 
     def pack_data(self) -> int:
         # Pack the packet and return the packet length
@@ -185,19 +368,82 @@ class KillServerConnectionPacket(Packet):
             "reason": self.reason,
         }
 
-        self.serialize_json_bytes()
+        self.serialize_bytes()
         return self.packet_length
     
     def unpack_data(self, buffer: bytes):
         self.packet_bytes = buffer
-        packet_json = self.deserialize_json_bytes()
+        packet_json = self.deserialize_bytes()
 
         self.reason = packet_json['reason']
 
 
+class StreamPacket(Packet):
+    # Stream frames are sent on the control connection of a multiplexed
+    # tunnel, they use a fixed binary layout instead of json since DATA
+    # frames carry raw tunneled bytes. Frames that only carry a stream id
+    # share this layout, each is its own class so they are never mistaken
+    # for one another by isinstance
+    stream_id: int = None
+
+    def pack_data(self) -> int:
+        self.packet_bytes = self.stream_id.to_bytes(4, byteorder="big")
+        self.packet_length = len(self.packet_bytes)
+        return self.packet_length
+
+    def unpack_data(self, buffer: bytes):
+        self.packet_bytes = buffer
+        self.packet_length = len(buffer)
+        self.stream_id = int.from_bytes(buffer[0:4], byteorder="big")
+
+
+class StreamOpenPacket(StreamPacket):
+    packet_id = 50
+
+
+class StreamDataPacket(Packet):
+    packet_id = 51
+    stream_id: int = None
+    data: bytes = b""
+
+    def pack_data(self) -> int:
+        self.packet_bytes = self.stream_id.to_bytes(4, byteorder="big") + self.data
+        self.packet_length = len(self.packet_bytes)
+        return self.packet_length
+
+    def unpack_data(self, buffer: bytes):
+        self.packet_bytes = buffer
+        self.packet_length = len(buffer)
+        self.stream_id = int.from_bytes(buffer[0:4], byteorder="big")
+        self.data = buffer[4:]
+
+
+class StreamClosePacket(StreamPacket):
+    packet_id = 52
+
+
+class StreamWindowUpdatePacket(Packet):
+    packet_id = 53
+    stream_id: int = None
+    increment: int = 0
+
+    def pack_data(self) -> int:
+        self.packet_bytes = (self.stream_id.to_bytes(4, byteorder="big")
+                             + self.increment.to_bytes(4, byteorder="big"))
+        self.packet_length = len(self.packet_bytes)
+        return self.packet_length
+
+    def unpack_data(self, buffer: bytes):
+        self.packet_bytes = buffer
+        self.packet_length = len(buffer)
+        self.stream_id = int.from_bytes(buffer[0:4], byteorder="big")
+        self.increment = int.from_bytes(buffer[4:8], byteorder="big")
+
+
 class ProtocolHandler:
     reader: asyncio.StreamReader = None
     writer: asyncio.StreamWriter = None
+    codec: str = CODEC_JSON
 
     def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         self.reader = reader
@@ -207,6 +453,11 @@ class ProtocolHandler:
         data = await self.reader.read(size)
         return data
 
+    async def recv_exactly(self, size: int):
+        # Raises asyncio.IncompleteReadError if the connection is closed
+        data = await self.reader.readexactly(size)
+        return data
+
         
     async def send(self, bytes: bytes):
         try:
@@ -222,42 +473,49 @@ class ProtocolHandler:
         await self.writer.wait_closed()
         return True
 
-    async def send_header(self, packet: Packet):
-        packet_len: int = packet.pack_data()
-        # header = self.packet_id.to_bytes(1, byteorder="big") + self.packet_length.to_bytes(4, byteorder="big")
-        # return header
-        # pack_len_bytes = self.packet_length.to_bytes(4, byteorder="big")
-
+    def build_header(self, packet: Packet) -> bytes:
         pack_id_b = packet.packet_id.to_bytes(1, byteorder="big")
-        pack_len_b = packet_len.to_bytes(4, byteorder="big")
-        
-        header = pack_id_b + pack_len_b
+        pack_len_b = packet.packet_length.to_bytes(4, byteorder="big")
+
+        return pack_id_b + pack_len_b
+
+    async def send_header(self, packet: Packet):
+        packet.codec = self.codec
+        packet.pack_data()
+        header = self.build_header(packet)
         res = await self.send(header)
         if not res:
             logging.debug("failed to send header")
             return False
         return True
         
-    async def send_packet(self, packet: Packet, send_header = True):
+    def encode_packet(self, packet: Packet, send_header = True) -> bytes:
+        # convert packet to bytes, once
+        packet.codec = self.codec
+        packet.pack_data()
+
+        data = packet.packet_bytes
+        if packet.packet_length <= EMPTY_BODY_LENGTH[self.codec]:
+            data = b""
         if send_header:
-            res = await self.send_header(packet)
-        
+            data = self.build_header(packet) + data
+        return data
+
+    async def send_packet(self, packet: Packet, send_header = True):
+        data = self.encode_packet(packet, send_header)
+
+        # Header and body go out in a single write so that packets sent
+        # concurrently on the same connection (heartbeats, stream frames)
+        # never interleave
+        res = await self.send(data)
         if not res:
-            logging.debug("failed to send header from packet")
+            logging.debug("failed to send packet bytes")
             return False
-        
-        # convert packet to bytes
-        packet.pack_data()
-        if packet.packet_length > 2: # json has 2 bytes of {}
-            res = await self.send(packet.packet_bytes)
-            if not res:
-                logging.debug("failed to send packet bytes")
-                return False
         return True
     
 
     async def recv_header(self) -> list[int, int]:
-        header = await self.recv(5)
+        header = await self.recv_exactly(5)
 
         packet_id = int.from_bytes(header[0:1], byteorder='big')
         json_length = int.from_bytes(header[1:5], byteorder='big')
@@ -273,10 +531,11 @@ class ProtocolHandler:
 
         recv_packet_class = packetList[packet_id]
         recv_packet = recv_packet_class()
+        recv_packet.codec = self.codec
         packet_bytes: bytes = None
 
-        if packet_length > 2:
-            packet_bytes = await self.recv(packet_length)
+        if packet_length > EMPTY_BODY_LENGTH[self.codec]:
+            packet_bytes = await self.recv_exactly(packet_length)
         
         recv_packet.unpack_data(packet_bytes)
         
@@ -286,9 +545,15 @@ class ProtocolHandler:
 packetList = {
     1: TunnelRequestPacket,
     2: NewConnectionHostResponsePacket,
+    3: PooledConnectionPacket,
+    50: StreamOpenPacket,
+    51: StreamDataPacket,
+    52: StreamClosePacket,
+    53: StreamWindowUpdatePacket,
     100: TunnelResponsePacket,
     101: NewClientConnectionPacket,
     200: HeartBeatPacket,
     201: LoadbalanceResponsePacket,
+    202: HeartBeatAckPacket,
     255: KillServerConnectionPacket,
 }
\ No newline at end of file
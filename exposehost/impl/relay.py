@@ -0,0 +1,353 @@
+import asyncio
+import logging
+import socket
+
+logger = logging.getLogger(__name__)
+
+# Relay engines for plain TCP legs, "socket" reads straight from the socket
+# into a reused buffer, "stream" goes through asyncio streams like TLS legs
+RELAY_ENGINE_SOCKET = "socket"
+RELAY_ENGINE_STREAM = "stream"
+RELAY_ENGINES = (RELAY_ENGINE_SOCKET, RELAY_ENGINE_STREAM)
+
+READ_SIZE = 4096
+
+# Relay read sizes start at MIN_BUFFER_SIZE and grow up to MAX_BUFFER_SIZE
+# while reads keep filling the whole buffer
+MIN_BUFFER_SIZE = 4096
+MAX_BUFFER_SIZE = 256 * 1024
+# Reads below a quarter of the buffer this many times in a row shrink it
+SHRINK_AFTER_SMALL_READS = 4
+
+# Stream writers make relays wait above HIGH_WATER bytes of unsent data,
+# until it is back below LOW_WATER
+WRITE_HIGH_WATER = 64 * 1024
+WRITE_LOW_WATER = 16 * 1024
+# Stream readers stop reading from the socket at twice this many bytes buffered
+READER_LIMIT = 64 * 1024
+
+# What a relay does when its writer does not take data: wait for it with the
+# reading side paused meanwhile, or close the writer after SLOW_READER_TIMEOUT
+SLOW_READER_PAUSE = "pause"
+SLOW_READER_KILL = "kill"
+SLOW_READER_POLICIES = (SLOW_READER_PAUSE, SLOW_READER_KILL)
+SLOW_READER_TIMEOUT = 30
+
+# Bytes the relays of one process may hold in read buffers and unsent data
+# before read buffers stop growing past their minimum size
+RELAY_MEMORY_LIMIT = 256 * 1024 * 1024
+
+
+class RelayMemory:
+    """
+    Bytes held by the relays of a process, read buffers, data written
+    but not drained yet and data received on multiplexed streams but not
+    read yet. Read buffers only grow while the total stays under limit,
+    the minimum size is always granted.
+    """
+
+    def __init__(self, limit: int = RELAY_MEMORY_LIMIT):
+        self.limit = limit
+        self.buffers = 0
+        self.pending = 0
+        self.streams = 0
+        self.peak = 0
+        self.stats = {"growth_denied": 0, "slow_readers_killed": 0}
+
+    @property
+    def buffered(self) -> int:
+        return self.buffers + self.pending + self.streams
+
+    def resize(self, old_size: int, new_size: int) -> bool:
+        # Account a read buffer going from old_size to new_size bytes,
+        # returns False if growing it would go over the limit
+        grow = new_size - old_size
+        if grow > 0 and old_size and self.buffered + grow > self.limit:
+            self.stats["growth_denied"] += 1
+            return False
+        self.buffers += grow
+        self.peak = max(self.peak, self.buffered)
+        return True
+
+    def get_stats(self) -> dict:
+        # buffers: read buffer bytes, pending: bytes waiting for a drain,
+        # streams: bytes received on mux streams, peak: highest total seen
+        stats = dict(self.stats)
+        stats.update(buffers=self.buffers, pending=self.pending, streams=self.streams, buffered=self.buffered,
+                     peak=self.peak, limit=self.limit)
+        return stats
+
+
+# Used by relays not given a RelayMemory of their own
+DEFAULT_RELAY_MEMORY = RelayMemory()
+
+
+class RelayConfig:
+    # Per-connection relay settings, shared by every relay of a Client or server
+    min_buffer: int = MIN_BUFFER_SIZE
+    max_buffer: int = MAX_BUFFER_SIZE
+    high_water: int = WRITE_HIGH_WATER
+    low_water: int = WRITE_LOW_WATER
+    reader_limit: int = READER_LIMIT
+    slow_reader: str = SLOW_READER_PAUSE
+    slow_reader_timeout: float = SLOW_READER_TIMEOUT
+    memory: RelayMemory = None
+
+    def __init__(self, min_buffer: int = MIN_BUFFER_SIZE, max_buffer: int = MAX_BUFFER_SIZE,
+                 high_water: int = WRITE_HIGH_WATER, low_water: int = WRITE_LOW_WATER,
+                 reader_limit: int = READER_LIMIT, slow_reader: str = SLOW_READER_PAUSE,
+                 slow_reader_timeout: float = SLOW_READER_TIMEOUT, memory: RelayMemory = None):
+        if min_buffer <= 0 or max_buffer < min_buffer:
+            raise ValueError("Relay buffer limits must satisfy 0 < min_buffer <= max_buffer")
+        if low_water < 0 or high_water < low_water:
+            raise ValueError("Relay watermarks must satisfy 0 <= low_water <= high_water")
+        if reader_limit <= 0:
+            raise ValueError("Relay reader_limit must be positive")
+        if slow_reader not in SLOW_READER_POLICIES:
+            raise ValueError("Unknown slow reader policy: %s" % slow_reader)
+        self.min_buffer = min_buffer
+        self.max_buffer = max_buffer
+        self.high_water = high_water
+        self.low_water = low_water
+        self.reader_limit = reader_limit
+        self.slow_reader = slow_reader
+        self.slow_reader_timeout = slow_reader_timeout
+        self.memory = memory or DEFAULT_RELAY_MEMORY
+
+
+DEFAULT_RELAY_CONFIG = RelayConfig()
+
+
+class RelayBuffer:
+    """
+    Read buffer of one relay direction. Doubles after reads that fill it
+    (bulk transfers) and halves after a run of small reads (interactive
+    traffic), staying within the RelayConfig limits. Readers without
+    recv_into return their own bytes, for them only the read size is
+    tracked and nothing is allocated or accounted in RelayMemory.
+    """
+
+    def __init__(self, config: RelayConfig, backed: bool = True):
+        self.config = config
+        self.backed = backed
+        self.size = 0
+        self.small_reads = 0
+        self.allocate(config.min_buffer)
+
+    def allocate(self, size: int):
+        if not self.backed:
+            self.size = size
+            return
+        # Stays at the current size if the process is out of relay memory
+        if not self.config.memory.resize(self.size, size):
+            return
+        self.size = size
+        self.buffer = bytearray(self.size)
+        self.view = memoryview(self.buffer)
+
+    def release(self):
+        if self.backed:
+            self.config.memory.resize(self.size, 0)
+        self.size = 0
+
+    def update(self, received: int):
+        # Adjust the buffer size to the last read
+        if received == self.size and self.size < self.config.max_buffer:
+            self.small_reads = 0
+            self.allocate(min(self.size * 2, self.config.max_buffer))
+        elif received < self.size // 4 and self.size > self.config.min_buffer:
+            self.small_reads += 1
+            if self.small_reads >= SHRINK_AFTER_SMALL_READS:
+                self.small_reads = 0
+                self.allocate(max(self.size // 2, self.config.min_buffer))
+        else:
+            self.small_reads = 0
+
+
+class SocketStream:
+    """
+    Plain TCP socket driven with the event loop's sock_* calls instead of a
+    transport. Implements the parts of StreamReader/StreamWriter used by the
+    forwarders, so the same object is passed as both reader and writer.
+    """
+    # write() keeps a reference to the data until drain(), so relay() can
+    # hand it views of its read buffer without copying
+    accepts_views = True
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.sock.setblocking(False)
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.loop = asyncio.get_running_loop()
+        self.send_queue = []
+        self.pending_calls = 0
+        self.closed = False
+
+    async def call(self, coro):
+        # The fd is only closed once no sock_* call is using it anymore
+        self.pending_calls += 1
+        try:
+            return await coro
+        finally:
+            self.pending_calls -= 1
+            if self.closed and not self.pending_calls:
+                self.sock.close()
+
+    async def recv_into(self, buffer) -> int:
+        if self.closed:
+            return 0
+        return await self.call(self.loop.sock_recv_into(self.sock, buffer))
+
+    async def read(self, size: int = -1) -> bytes:
+        if self.closed:
+            return b""
+        if size < 0:
+            size = READ_SIZE
+        return await self.call(self.loop.sock_recv(self.sock, size))
+
+    def write(self, data):
+        self.send_queue.append(data)
+
+    async def drain(self):
+        while self.send_queue:
+            if self.closed:
+                raise ConnectionResetError("Socket is closed")
+            data = self.send_queue.pop(0)
+            await self.call(self.loop.sock_sendall(self.sock, data))
+
+    def is_closing(self) -> bool:
+        return self.closed
+
+    def at_eof(self) -> bool:
+        # Whether the peer closed the connection, peeks without consuming
+        # anything so an idle pooled connection can be checked before reuse
+        if self.closed:
+            return True
+        try:
+            return self.sock.recv(1, socket.MSG_PEEK) == b""
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            return True
+
+    def get_extra_info(self, name: str, default=None):
+        if name == "socket":
+            return self.sock
+        if name == "peername":
+            try:
+                return self.sock.getpeername()
+            except OSError:
+                return default
+        return default
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.send_queue.clear()
+        try:
+            # Wakes up any pending recv with EOF
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if not self.pending_calls:
+            self.sock.close()
+
+    async def wait_closed(self):
+        pass
+
+
+async def open_socket_stream(host: str, port: int) -> SocketStream:
+    # Counterpart of asyncio.open_connection for plain TCP legs
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+
+    error = OSError("Could not resolve %s:%s" % (host, port))
+    for family, sock_type, proto, _, address in infos:
+        sock = socket.socket(family, sock_type, proto)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, address)
+        except OSError as e:
+            sock.close()
+            error = e
+            continue
+        return SocketStream(sock)
+    raise error
+
+
+def kill_slow_reader(writer, memory: RelayMemory):
+    # The peer has not taken data for slow_reader_timeout seconds, a stream
+    # writer would wait to flush its buffer on close, abort it instead
+    memory.stats["slow_readers_killed"] += 1
+    logger.info("Closing connection of a slow reader")
+    transport = getattr(writer, "transport", None)
+    if transport:
+        transport.abort()
+    else:
+        writer.close()
+
+
+async def drain(writer, config: RelayConfig, size: int):
+    # Wait for writer to take size bytes, applying the slow reader policy
+    memory = config.memory
+    memory.pending += size
+    memory.peak = max(memory.peak, memory.buffered)
+    handle = None
+    if config.slow_reader == SLOW_READER_KILL:
+        handle = asyncio.get_running_loop().call_later(config.slow_reader_timeout, kill_slow_reader, writer, memory)
+    try:
+        await writer.drain()
+    finally:
+        memory.pending -= size
+        if handle:
+            handle.cancel()
+
+
+def set_write_limits(writer, config: RelayConfig):
+    # Only stream writers buffer beyond the chunk being drained
+    transport = getattr(writer, "transport", None)
+    if transport:
+        transport.set_write_buffer_limits(high=config.high_water, low=config.low_water)
+
+
+async def relay(reader, writer, config: RelayConfig = DEFAULT_RELAY_CONFIG, counter=None, throttle=None):
+    # Copy data from reader to writer until reader reaches EOF, counter is
+    # called with the size of every chunk relayed and throttle awaited with it
+    set_write_limits(writer, config)
+    relay_buffer = RelayBuffer(config, backed=hasattr(reader, "recv_into"))
+    try:
+        if relay_buffer.backed:
+            # Read straight into the relay buffer
+            accepts_views = getattr(writer, "accepts_views", False)
+            while True:
+                size = await reader.recv_into(relay_buffer.view)
+                if not size:
+                    break
+                # Transports may keep a reference to written data, only pass
+                # the buffer itself to writers that are done with it after drain
+                data = relay_buffer.view[:size]
+                writer.write(data if accepts_views else bytes(data))
+                await drain(writer, config, size)
+                data.release()
+                relay_buffer.update(size)
+                if counter:
+                    counter(size)
+                if throttle:
+                    await throttle(size)
+            return
+
+        while True:
+            data = await reader.read(relay_buffer.size)
+            if not data:
+                break
+            writer.write(data)
+            await drain(writer, config, len(data))
+            relay_buffer.update(len(data))
+            if counter:
+                counter(len(data))
+            if throttle:
+                await throttle(len(data))
+    finally:
+        relay_buffer.release()
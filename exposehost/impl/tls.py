@@ -0,0 +1,89 @@
+import asyncio
+import contextvars
+import logging
+import ssl
+import time
+
+logger = logging.getLogger(__name__)
+
+# Server address of the connection being opened by open_connection(),
+# asyncio has no way to hand a session to the handshake itself
+connecting_to: contextvars.ContextVar = contextvars.ContextVar("connecting_to", default=None)
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    Client context that offers the last TLS session of a server when a new
+    connection to it is opened with open_connection(), so reconnects resume
+    the session instead of doing a full handshake.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # SSLContext is set up in __new__
+        super().__init__()
+        # (host, port) -> last ssl object and last resumable session
+        self.last_connections: dict[tuple[str, int], ssl.SSLObject] = {}
+        self.sessions: dict[tuple[str, int], ssl.SSLSession] = {}
+        # Workers behind the load balancer share ticket keys, a session of
+        # one port of a host is worth offering to another
+        self.host_sessions: dict[str, tuple[str, int]] = {}
+        self.stats = {"resumed": 0, "full": 0, "resumed_time_total": 0.0, "full_time_total": 0.0}
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        address = connecting_to.get()
+        if session is None and not server_side and address:
+            session = self.get_session(address)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def get_session(self, address: tuple[str, int]) -> ssl.SSLSession:
+        # TLS 1.3 tickets arrive after the handshake, the session of the
+        # last connection is only picked up once it has one
+        last_connection = self.last_connections.get(address)
+        if last_connection:
+            session = last_connection.session
+            if session and (session.has_ticket or session.id):
+                self.sessions[address] = session
+                self.host_sessions[address[0]] = address
+
+        session = self.sessions.get(address)
+        if not session and address[0] in self.host_sessions:
+            session = self.sessions.get(self.host_sessions[address[0]])
+        if session and session.time + session.timeout < time.time():
+            return None
+        return session
+
+    def handshake_done(self, address: tuple[str, int], ssl_object: ssl.SSLObject, handshake_time: float):
+        self.last_connections[address] = ssl_object
+        kind = "resumed" if ssl_object.session_reused else "full"
+        self.stats[kind] += 1
+        self.stats[kind + "_time_total"] += handshake_time
+
+    def get_stats(self) -> dict:
+        # resumed/full: handshakes that resumed a session or did a full one,
+        # times include connecting
+        stats = dict(self.stats)
+        for kind in ("resumed", "full"):
+            stats[kind + "_time_avg"] = stats[kind + "_time_total"] / stats[kind] if stats[kind] else 0.0
+        return stats
+
+
+def create_client_context() -> ResumingSSLContext:
+    # Same settings as ssl.create_default_context for server authentication
+    context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+    return context
+
+
+async def open_connection(host: str, port: int, context: ssl.SSLContext):
+    # asyncio.open_connection over TLS, resuming the last session of the
+    # server when context is a ResumingSSLContext
+    token = connecting_to.set((host, port))
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection(host, port, ssl=context)
+    finally:
+        connecting_to.reset(token)
+
+    if isinstance(context, ResumingSSLContext):
+        context.handshake_done((host, port), writer.get_extra_info("ssl_object"), time.perf_counter() - started)
+    return reader, writer
@@ -6,5 +6,33 @@ logger = logging.getLogger(" Server ")
 logger.info("Starting")
 
 MAX_TIMEOUT = 5
+# Pooled client connections are dropped this many seconds before the
+# client's own idle limit, so the server never hands out one being closed
+POOL_EXPIRY_MARGIN = 2
+# Idle tunnels get a heartbeat every HEARTBEAT_INTERVAL seconds, tunnels
+# whose client has not been heard from in DEAD_PEER_DEADLINE seconds are closed
+HEARTBEAT_INTERVAL = 5
+DEAD_PEER_DEADLINE = 15
+# Resolution of the liveness timer wheel, in seconds
+LIVENESS_TICK = 0.5
+# Pause of a forwarder accept loop after accept fails, e.g. when the
+# process is out of file descriptors, in seconds
+ACCEPT_RETRY_DELAY = 0.1
+# nginx config changes made within this many seconds share one reload
+NGINX_RELOAD_WINDOW = 0.2
+# How http tunnels are routed by nginx, a config file per tunnel or one
+# subdomain -> port map per server process
+NGINX_ROUTING_FILES = "files"
+NGINX_ROUTING_MAP = "map"
+# Bytes a tunnel relays before giving the event loop to other tunnels,
+# scaled by the tunnel's weight
+SCHEDULER_QUANTUM = 256 * 1024
+# Seconds between two metrics reports of a server process to the parent
+METRICS_REPORT_INTERVAL = 1
+# Metrics endpoints only listen locally
+METRICS_HOST = "127.0.0.1"
+# TLS 1.3 session tickets sent per handshake, clients only keep the latest
+TLS_SESSION_TICKETS = 1
 DOMAIN_NAME = 'exposehost.local'
-CURRENT_DOMAINS: set = set()
\ No newline at end of file
+# TCPProtocolHandler waiting for its host connection, by connection id
+PENDING_CONNECTIONS: dict = {}
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from exposehost.server.constants import logger
+
+# Writers wait this many seconds for the database lock
+REGISTRY_BUSY_TIMEOUT = 5
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def registry_path(port: int) -> str:
+    # One registry per deployment, named after the load balancer port
+    return os.path.join(tempfile.gettempdir(), "exposehost-domains-%s.db" % port)
+
+
+class DomainRegistry:
+    """
+    Domains claimed by tunnels, shared by every server process through an
+    SQLite database in WAL mode. A claim is a single INSERT on the primary
+    key, so two processes can never both get the same domain. Without a
+    path the registry is an in-memory database private to the process.
+
+    Writes may wait up to REGISTRY_BUSY_TIMEOUT for another process holding
+    the database lock, claim() and release() run them in an executor so
+    the event loop is never blocked.
+    """
+
+    executor: ThreadPoolExecutor = None
+
+    def __init__(self, path: str = None):
+        self.path = path
+        # Connections can not be shared across fork, each process opens its
+        # own on first use
+        self.connection: sqlite3.Connection = None
+        self.connection_pid: int = None
+        # The connection is used by the executor thread and for the odd
+        # lookup from the event loop, never by both at once
+        self.lock = threading.Lock()
+        # Domains claimed by this process
+        self.claimed: set[str] = set()
+        self.stats = {"claims": 0, "conflicts": 0, "reclaimed": 0}
+
+    def connect(self) -> sqlite3.Connection:
+        pid = os.getpid()
+        if self.connection and self.connection_pid == pid:
+            return self.connection
+
+        # A connection inherited from the parent process is left alone
+        self.connection = sqlite3.connect(self.path or ":memory:", timeout=REGISTRY_BUSY_TIMEOUT, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection_pid = pid
+        self.claimed = set()
+        if self.path:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS domains (domain TEXT PRIMARY KEY, pid INTEGER NOT NULL) WITHOUT ROWID"
+        )
+        return self.connection
+
+    def reset(self):
+        # Forget every claim, done once by the parent process on startup
+        self.connect().execute("DELETE FROM domains")
+        self.claimed.clear()
+
+    def close(self):
+        # The parent closes its connection before forking server processes
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    async def run(self, func, *args):
+        # Created on first use, in the server process
+        if not self.executor:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="domain-registry")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def claim(self, domain: str) -> bool:
+        if domain in self.claimed:
+            # Already held by a tunnel of this process, no need to ask sqlite
+            self.stats["conflicts"] += 1
+            return False
+        return await self.run(self.insert_claim, domain)
+
+    async def release(self, domain: str):
+        if domain not in self.claimed:
+            return
+        self.claimed.discard(domain)
+        await self.run(self.delete_claim, domain)
+
+    def insert_claim(self, domain: str) -> bool:
+        with self.lock:
+            connection = self.connect()
+            pid = os.getpid()
+
+            cursor = connection.execute("INSERT OR IGNORE INTO domains (domain, pid) VALUES (?, ?)", (domain, pid))
+            if not cursor.rowcount:
+                row = connection.execute("SELECT pid FROM domains WHERE domain = ?", (domain,)).fetchone()
+                if not row or row[0] == pid or process_alive(row[0]):
+                    self.stats["conflicts"] += 1
+                    return False
+
+                # Left behind by a server process that died, take it over
+                logger.info("Reclaiming %s from dead server process %s", domain, row[0])
+                connection.execute("DELETE FROM domains WHERE domain = ? AND pid = ?", (domain, row[0]))
+                cursor = connection.execute("INSERT OR IGNORE INTO domains (domain, pid) VALUES (?, ?)", (domain, pid))
+                if not cursor.rowcount:
+                    self.stats["conflicts"] += 1
+                    return False
+                self.stats["reclaimed"] += 1
+
+            self.claimed.add(domain)
+            self.stats["claims"] += 1
+            return True
+
+    def delete_claim(self, domain: str):
+        with self.lock:
+            self.connect().execute("DELETE FROM domains WHERE domain = ? AND pid = ?", (domain, os.getpid()))
+
+    def __contains__(self, domain: str) -> bool:
+        if domain in self.claimed:
+            return True
+        with self.lock:
+            row = self.connect().execute("SELECT 1 FROM domains WHERE domain = ?", (domain,)).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connect().execute("SELECT COUNT(*) FROM domains").fetchone()[0]
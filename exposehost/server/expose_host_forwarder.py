@@ -1,8 +1,11 @@
 from exposehost.impl import packets 
+from exposehost.impl.relay import relay, SocketStream, RelayConfig, RELAY_ENGINE_SOCKET, DEFAULT_RELAY_CONFIG
 import asyncio
 from exposehost.helpers import random_string
+from exposehost.server.scheduler import TunnelScheduler, TunnelLimits, DEFAULT_TUNNEL_LIMITS
 from exposehost.server.constants import *
 import socket
+import time
 
 
 class TCPProtocolHandler:
@@ -14,66 +17,107 @@ class TCPProtocolHandler:
     server_host_writer: asyncio.StreamWriter = None
     client_reader: asyncio.StreamReader = None
     client_writer: asyncio.StreamWriter = None
+    host_connected: asyncio.Future = None      # resolved by set_host_connection
 
     def __init__(self, exposeHostClassInstance):
         self.expostHostClassInstance = exposeHostClassInstance
         self.connection_id = random_string(32)
+        self.host_connected = asyncio.get_running_loop().create_future()
+        PENDING_CONNECTIONS[self.connection_id] = self
     
-    async def forward(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    async def forward(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, counter=None):
         try:
-            while True:
-                data = await reader.read(4096)
-                if not data:
-                    break
-                writer.write(data)
-                await writer.drain()
+            await relay(reader, writer, self.expostHostClassInstance.relay_config, counter,
+                        self.expostHostClassInstance.scheduler.throttle)
 
         finally:
             writer.close()
             await writer.wait_closed()
     
     async def set_host_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self.host_connected.done():
+            # Waiting for the host timed out, nobody will use this connection
+            writer.close()
+            await writer.wait_closed()
+            return
+
         self.server_host_reader = reader
         self.server_host_writer = writer
         self.is_host_connected = True
+        self.host_connected.set_result(True)
+        PENDING_CONNECTIONS.pop(self.connection_id, None)
         writer.write(b"\x01")
         await writer.drain()
 
+    async def wait_for_host_connection(self) -> bool:
+        # Wait for the hosting client to connect back, returns False on timeout
+        server = self.expostHostClassInstance.serverConnectionClassInstance.serverClassInstance
+        rendezvous_stats = server.rendezvous_stats
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self.host_connected, MAX_TIMEOUT)
+        except asyncio.TimeoutError:
+            rendezvous_stats["timeouts"] += 1
+            return False
+
+        latency = time.monotonic() - started
+        rendezvous_stats["connections"] += 1
+        rendezvous_stats["latency_total"] += latency
+        rendezvous_stats["latency_max"] = max(rendezvous_stats["latency_max"], latency)
+        server.rendezvous_histogram.observe(latency)
+        return True
+
     async def kill_client(self):
         # Kill the client connection
         self.client_writer.close()
         await self.client_writer.wait_closed()
 
-    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, initial_data: bytes = b""):
+        # initial_data was already read from the client by a router
         self.client_reader = reader
         self.client_writer = writer
         
+        server_connection = self.expostHostClassInstance.serverConnectionClassInstance
+        server_connection.serverClassInstance.active_connections += 1
         try:
-            # Send tunnel ID over the control plane
-            await self.expostHostClassInstance.serverConnectionClassInstance.new_tunnel_connection(self.connection_id)
-
-            # Wait for 5 seconds for hosting server to connect back
-            timeoutCounter = 0
-            while self.is_host_connected != True:
-                # Sleep for 10ms until we get a connection from the client
-                await asyncio.sleep(0.01)
-
-                # If timeout is reached, break and close connection
-                if timeoutCounter >= round(MAX_TIMEOUT / 0.01):
-                    return
-                timeoutCounter += 1
+            if server_connection.multiplexer:
+                # Multiplexed tunnel, open a stream on the control connection
+                # instead of waiting for the client to connect back
+                stream = await server_connection.multiplexer.open_stream()
+                self.server_host_reader = stream
+                self.server_host_writer = stream
+                self.is_host_connected = True
+                PENDING_CONNECTIONS.pop(self.connection_id, None)
+            else:
+                # Use an idle connection kept open by the client if there is one
+                pooled = await server_connection.take_pooled_connection(self.connection_id)
+                if pooled:
+                    await self.set_host_connection(*pooled)
+                else:
+                    # Send tunnel ID over the control plane
+                    await server_connection.new_tunnel_connection(self.connection_id)
+
+                    # Wait for 5 seconds for hosting server to connect back
+                    if not await self.wait_for_host_connection():
+                        return
 
             # If we reach here, host connection is set by set_server call
             # Forward forvever
             self.is_forwarding = True
+            if initial_data:
+                self.server_host_writer.write(initial_data)
+                await self.server_host_writer.drain()
+                server_connection.count_bytes_in(len(initial_data))
             await asyncio.gather(
-                self.forward(self.client_reader, self.server_host_writer),
-                self.forward(self.server_host_reader, self.client_writer)
+                self.forward(self.client_reader, self.server_host_writer, server_connection.count_bytes_in),
+                self.forward(self.server_host_reader, self.client_writer, server_connection.count_bytes_out)
                 )
             
         except Exception as e:
             logger.error("Error at TCP Procotol handler: %s", e)
         finally:
+            server_connection.serverClassInstance.active_connections -= 1
+            PENDING_CONNECTIONS.pop(self.connection_id, None)
             if self.is_host_connected:
                 self.server_host_writer.close()
                 await self.server_host_writer.wait_closed()
@@ -91,44 +135,108 @@ class ExposeHostForwarder(packets.ProtocolHandler):
     serverConnectionClassInstance = None
     sock4 = None
     serverSocket: asyncio.Server = None
-    tcp_servers: list[TCPProtocolHandler] = []
+    tcp_servers: set[TCPProtocolHandler] = None
     sock_name: list = None
+    relay_engine: str = RELAY_ENGINE_SOCKET
+    relay_config: RelayConfig = None
+    scheduler: TunnelScheduler = None
+    accept_task: asyncio.Task = None
 
-    def __init__(self, serverConnectionClassInstance, protocol, exposed_port):
+    def __init__(self, serverConnectionClassInstance, protocol, exposed_port, relay_engine=RELAY_ENGINE_SOCKET,
+                 relay_config: RelayConfig = DEFAULT_RELAY_CONFIG, limits: TunnelLimits = DEFAULT_TUNNEL_LIMITS):
         self.serverConnectionClassInstance = serverConnectionClassInstance
         self.protocol = protocol
         self.exposed_port = exposed_port
+        self.relay_engine = relay_engine
+        # Buffer sizes, watermarks and slow reader policy of the server
+        self.relay_config = relay_config
+        # Byte and connection rate of this tunnel, and its share of the loop
+        self.scheduler = TunnelScheduler(limits)
+        self.tcp_servers = set()
+        self.connection_tasks: set[asyncio.Task] = set()
+
+
+    async def handleTCPClientConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, initial_data: bytes = b""):
+        if not self.scheduler.allow_connection():
+            logger.debug("Connection rate of %s exceeded, refusing connection",
+                         self.serverConnectionClassInstance.full_domain)
+            writer.close()
+            await writer.wait_closed()
+            return
 
-
-    async def handleTCPClientConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         client_handler = TCPProtocolHandler(self)
-        self.tcp_servers.append(client_handler)
-        await client_handler.handle_client(reader, writer)
+        self.tcp_servers.add(client_handler)
+        try:
+            await client_handler.handle_client(reader, writer, initial_data)
+        finally:
+            self.tcp_servers.discard(client_handler)
 
     
     async def startExposedServer(self):
         self.sock4 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock4.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock4.bind(("0.0.0.0", self.exposed_port))
-        self.sock4.listen(5)
+        # asyncio.start_server listens again with a backlog of 100, use the
+        # same when accepting ourselves
+        self.sock4.listen(100)
         self.sock4.setblocking(False)
 
-        self.serverSocket = await asyncio.start_server(self.handleTCPClientConnection, sock=self.sock4)
-        sock_name = self.serverSocket.sockets[0].getsockname()
+        if self.relay_engine == RELAY_ENGINE_SOCKET:
+            # Accept plain sockets ourselves, they are relayed without streams
+            self.accept_task = asyncio.create_task(self.acceptSocketConnections())
+            sock_name = self.sock4.getsockname()
+        else:
+            self.serverSocket = await asyncio.start_server(self.handleTCPClientConnection, sock=self.sock4,
+                                                           limit=self.relay_config.reader_limit)
+            sock_name = self.serverSocket.sockets[0].getsockname()
         logger.debug("Started to listen client exposed request on port: %s", sock_name[1])
         self.sock_name = sock_name
         return sock_name
 
+    async def acceptSocketConnections(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                client_sock, _ = await loop.sock_accept(self.sock4)
+                self.startSocketConnection(client_sock)
+
+                # Empty the backlog before waiting again
+                while True:
+                    try:
+                        client_sock, _ = self.sock4.accept()
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    self.startSocketConnection(client_sock)
+            except OSError as e:
+                if self.sock4.fileno() == -1:
+                    return
+                # Out of file descriptors or a connection reset before it
+                # was accepted, the listening socket is still good
+                logger.error("Error accepting connections on port %s: %s", self.sock_name[1], e)
+                await asyncio.sleep(ACCEPT_RETRY_DELAY)
+
+    def startSocketConnection(self, client_sock: socket.socket):
+        client_stream = SocketStream(client_sock)
+        task = asyncio.create_task(self.handleTCPClientConnection(client_stream, client_stream))
+        self.connection_tasks.add(task)
+        task.add_done_callback(self.connection_tasks.discard)
+
     async def stop_server(self):
-        for client in self.tcp_servers:
+        for client in list(self.tcp_servers):
             await client.kill_client()
 
-        self.tcp_servers = []
+        self.tcp_servers.clear()
 
         # Close the forwarder server
         if self.serverSocket:
             logger.debug("Stopped server at port: %s", self.sock_name[1])
             self.serverSocket.close()
+        if self.accept_task:
+            logger.debug("Stopped server at port: %s", self.sock_name[1])
+            self.accept_task.cancel()
+            self.sock4.close()
         
-        # Remove the forwarder instance from the server connection class instance
-        self.serverConnectionClassInstance.forwarders.remove(self)
\ No newline at end of file
+        # Remove the forwarder instance from the server connection class instance,
+        # a forwarder can be stopped by a failed connection and by its tunnel
+        if self in self.serverConnectionClassInstance.forwarders:
+            self.serverConnectionClassInstance.forwarders.remove(self)
\ No newline at end of file
@@ -0,0 +1,201 @@
+from exposehost.server.constants import *
+from exposehost.impl.http_pool import HttpReader, HttpHead, body_framing, BODY_LENGTH, BODY_CHUNKED, BODY_CHUNK_SIZE
+import asyncio
+import ssl
+
+# Largest request head read to find the Host header
+MAX_HEAD_SIZE = 64 * 1024
+
+
+class HttpRouter:
+    """
+    In-process front door for http tunnels, used instead of nginx. Reads the
+    head of the first request of a connection, picks the tunnel from its
+    Host header and relays the connection, including the head, to that
+    tunnel. Keep-alive and pipelined requests follow on the same connection
+    as long as they are for the same Host, the connection ends at the first
+    request for another one so it never reaches the wrong tunnel.
+    """
+    server_socket: asyncio.Server = None
+
+    def __init__(self, serverClassInstance, host: str, port: int, ssl_context: ssl.SSLContext = None):
+        self.serverClassInstance = serverClassInstance
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.stats = {"routed": 0, "not_found": 0, "bad_requests": 0, "host_changes": 0}
+
+    async def start(self):
+        self.server_socket = await asyncio.start_server(
+            self.handle_connection, self.host, self.port, ssl=self.ssl_context,
+            limit=MAX_HEAD_SIZE, backlog=100)
+        self.port = self.server_socket.sockets[0].getsockname()[1]
+        logger.info("HTTP router listening on %s:%s (tls: %s)", self.host, self.port, bool(self.ssl_context))
+        return self.port
+
+    async def stop(self):
+        if self.server_socket:
+            self.server_socket.close()
+            await self.server_socket.wait_closed()
+
+    async def respond_error(self, writer: asyncio.StreamWriter, status: str):
+        body = status.encode() + b"\r\n"
+        writer.write(b"HTTP/1.1 %s\r\nContent-Type: text/plain\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s"
+                     % (status.encode(), len(body), body))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        requests = HostRequests(self, HttpReader(reader))
+        try:
+            head = await asyncio.wait_for(requests.source.read_until(b"\r\n\r\n"), MAX_TIMEOUT)
+            if head is None:
+                raise ConnectionError("Connection closed before a request")
+            full_domain = parse_host(head)
+            head = requests.start(full_domain, head)
+        except (asyncio.TimeoutError, ValueError, ConnectionError, ssl.SSLError):
+            self.stats["bad_requests"] += 1
+            await self.respond_error(writer, "400 Bad Request")
+            return
+
+        server_connection = self.serverClassInstance.domains.get(full_domain)
+        if not server_connection or server_connection.protocol != "http" or not server_connection.forwarder:
+            self.stats["not_found"] += 1
+            await self.respond_error(writer, "404 Not Found")
+            return
+
+        self.stats["routed"] += 1
+        await server_connection.forwarder.handleTCPClientConnection(requests, VisitorWriter(requests, writer),
+                                                                    initial_data=head)
+
+
+class HostRequests:
+    """
+    Reader over the visitor side of a routed connection that walks the
+    request boundaries and returns EOF at the first request for another
+    Host than the one routed to. After a protocol upgrade request it waits
+    for the response, the rest of the connection is passed through as it is
+    if the service switched protocols.
+    """
+
+    def __init__(self, router: HttpRouter, source: HttpReader):
+        self.router = router
+        self.source = source
+        self.host: str = None
+        self.body_left = 0          # bytes left of a body or chunk
+        self.chunked = False        # in a chunked body
+        self.trailers = False       # in the trailers of a chunked body
+        self.switching: asyncio.Future = None   # resolved with the outcome of an upgrade request
+        self.upgraded = False
+
+    def start(self, host: str, head: bytes) -> bytes:
+        # Route to host, head is the first request, already read
+        self.host = host
+        return self.request(head)
+
+    def request(self, head: bytes) -> bytes:
+        # Raises ValueError if the body length can not be found
+        request = HttpHead(head)
+        framing, length = body_framing(request, is_response=False)
+        if framing == BODY_LENGTH:
+            self.body_left = length
+        elif framing == BODY_CHUNKED:
+            self.chunked = True
+        if request.get(b"upgrade") is not None:
+            self.switching = asyncio.get_running_loop().create_future()
+        return head
+
+    def response(self, data: bytes):
+        # Called with the data written to the visitor, None once it is closed
+        if not self.switching or self.switching.done():
+            return
+        if data is None:
+            self.switching.set_result(False)
+        elif data.startswith(b"HTTP/"):
+            status = data[9:12]
+            # Interim responses come before the one to the upgrade request
+            if status == b"101" or not status.startswith(b"1"):
+                self.switching.set_result(status == b"101")
+
+    async def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            size = BODY_CHUNK_SIZE
+        try:
+            if self.body_left:
+                data = await self.source.read_some(min(size, self.body_left))
+                if not data:
+                    raise ConnectionError("Connection closed in the middle of a body")
+                self.body_left -= len(data)
+                return data
+            if self.chunked:
+                return await self.read_chunk_line()
+            if self.switching:
+                self.upgraded = await self.switching
+                self.switching = None
+            if self.upgraded:
+                return await self.source.read_some(size)
+
+            head = await self.source.read_until(b"\r\n\r\n")
+            if head is None:
+                return b""
+            if parse_host(head) != self.host:
+                logger.debug("Request for another host on a connection routed to %s, closing it", self.host)
+                self.router.stats["host_changes"] += 1
+                return b""
+            return self.request(head)
+        except (ValueError, ConnectionError, ssl.SSLError) as e:
+            logger.debug("Ending connection routed to %s: %s", self.host, e)
+            self.router.stats["bad_requests"] += 1
+            return b""
+
+    async def read_chunk_line(self) -> bytes:
+        line = await self.source.read_until(b"\r\n")
+        if line is None:
+            raise ConnectionError("Connection closed in the middle of a chunked body")
+        if self.trailers:
+            # Trailers end with an empty line
+            if line == b"\r\n":
+                self.chunked = self.trailers = False
+            return line
+
+        size = int(line.split(b";", 1)[0].strip(), 16)
+        if size:
+            self.body_left = size + 2       # chunk and its CRLF
+        else:
+            self.trailers = True
+        return line
+
+
+class VisitorWriter:
+    """
+    Writer to the visitor side of a routed connection, shows the responses
+    to the HostRequests reader of the same connection.
+    """
+
+    def __init__(self, requests: HostRequests, writer: asyncio.StreamWriter):
+        self.requests = requests
+        self.writer = writer
+
+    def write(self, data: bytes):
+        self.requests.response(data)
+        self.writer.write(data)
+
+    def close(self):
+        self.requests.response(None)
+        self.writer.close()
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+
+def parse_host(head: bytes) -> str:
+    # Host header of a request head without the port, None if missing
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"host":
+            host = value.strip().decode("latin-1").lower()
+            return host.rsplit(":", 1)[0] if not host.endswith("]") else host
+    return None
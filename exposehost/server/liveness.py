@@ -0,0 +1,136 @@
+from exposehost.impl import packets
+from exposehost.server.constants import *
+from exposehost.server.metrics import Histogram
+import asyncio
+import math
+import time
+
+
+class TunnelLiveness:
+    # Liveness state of one tunnel, kept by the LivenessManager
+    last_seen: float = None         # last packet received from the client
+    last_traffic: float = None      # same, not counting heartbeat answers
+    ping_sent_at: float = None      # unanswered heartbeat
+    rtt: float = None               # seconds, from the last answered heartbeat
+    slot: int = None
+
+    def __init__(self, slot: int):
+        self.last_seen = self.last_traffic = time.monotonic()
+        self.slot = slot
+
+    def seen(self):
+        self.last_seen = self.last_traffic = time.monotonic()
+
+    def acked(self) -> float:
+        # Returns the round trip time if the answer is to our heartbeat
+        self.last_seen = time.monotonic()
+        if self.ping_sent_at is None:
+            return None
+        self.rtt = self.last_seen - self.ping_sent_at
+        self.ping_sent_at = None
+        return self.rtt
+
+
+class LivenessManager:
+    """
+    Heartbeats every tunnel of a Server from a single timer wheel task
+    instead of a task per tunnel. Each tunnel sits in one slot of the wheel
+    and is visited once per turn (every `interval` seconds), tunnels are
+    spread over the slots so each tick only handles a batch of them.
+
+    A visited tunnel that received traffic within the interval is skipped,
+    one whose client answers heartbeats and has been silent for longer than
+    `deadline` is killed, any other gets a heartbeat.
+    """
+
+    def __init__(self, interval: float = HEARTBEAT_INTERVAL, deadline: float = DEAD_PEER_DEADLINE,
+                 tick: float = LIVENESS_TICK):
+        if deadline <= interval:
+            raise ValueError("Dead peer deadline must be longer than the heartbeat interval")
+        self.interval = interval
+        self.deadline = deadline
+        self.tick = tick
+        self.wheel: list[dict] = [{} for _ in range(max(1, math.ceil(interval / tick)))]
+        self.current_slot = 0
+        self.next_slot = 0
+        self.task: asyncio.Task = None
+        self.kill_tasks: set[asyncio.Task] = set()
+        # Encoded HeartBeatPacket by codec, the packet never changes
+        self.heartbeat_frames: dict[str, bytes] = {}
+        self.stats = {"heartbeats": 0, "skipped": 0, "dead": 0}
+        self.rtt_histogram = Histogram()
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def register(self, connection) -> TunnelLiveness:
+        # Fill the slots round robin so every tick has a similar batch
+        liveness = TunnelLiveness(self.next_slot)
+        self.wheel[self.next_slot][connection] = liveness
+        self.next_slot = (self.next_slot + 1) % len(self.wheel)
+        return liveness
+
+    def unregister(self, connection, liveness: TunnelLiveness):
+        self.wheel[liveness.slot].pop(connection, None)
+
+    def acked(self, liveness: TunnelLiveness):
+        rtt = liveness.acked()
+        if rtt is not None:
+            self.rtt_histogram.observe(rtt)
+
+    def get_rtt_stats(self) -> dict:
+        rtts = [liveness.rtt for slot in self.wheel for liveness in slot.values()
+                if liveness.rtt is not None]
+        if not rtts:
+            return {"tunnels": 0, "rtt_avg": None, "rtt_max": None}
+        return {"tunnels": len(rtts), "rtt_avg": sum(rtts) / len(rtts), "rtt_max": max(rtts)}
+
+    def heartbeat_frame(self, connection) -> bytes:
+        frame = self.heartbeat_frames.get(connection.codec)
+        if frame is None:
+            frame = connection.encode_packet(packets.HeartBeatPacket())
+            self.heartbeat_frames[connection.codec] = frame
+        return frame
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.current_slot = (self.current_slot + 1) % len(self.wheel)
+            self.check_slot(self.wheel[self.current_slot])
+
+    def check_slot(self, slot: dict):
+        now = time.monotonic()
+        for connection, liveness in list(slot.items()):
+            silent_for = now - liveness.last_seen
+
+            if connection.heartbeat_ack and silent_for > self.deadline:
+                self.stats["dead"] += 1
+                self.kill(connection, "No heartbeat answer for %.0f seconds" % silent_for)
+                continue
+
+            if now - liveness.last_traffic < self.interval:
+                # Client was heard from recently, no need to ask
+                self.stats["skipped"] += 1
+                continue
+
+            if connection.writer.is_closing():
+                self.kill(connection, "Connection closed during heartbeat check")
+                continue
+
+            # 5 bytes, written without waiting for the transport to drain
+            connection.writer.write(self.heartbeat_frame(connection))
+            if liveness.ping_sent_at is None:
+                liveness.ping_sent_at = now
+            self.stats["heartbeats"] += 1
+
+    def kill(self, connection, reason: str):
+        self.unregister(connection, connection.liveness)
+        task = asyncio.create_task(connection.kill_server(reason))
+        self.kill_tasks.add(task)
+        task.add_done_callback(self.kill_tasks.discard)
@@ -0,0 +1,84 @@
+import asyncio
+import multiprocessing
+import time
+from exposehost.server.metrics import Histogram
+
+# Columns of a LoadTable row
+LOAD_FIELDS = ("tunnels", "connections", "bytes_per_second", "loop_lag")
+# Load score of one unit of each column, 10ms of event loop lag weighs as
+# much as a tunnel, 1 MB/s as much as ten connections
+LOAD_WEIGHTS = (1.0, 0.1, 1.0 / (1024 * 1024), 100.0)
+# Seconds between two load reports of a server process
+LOAD_REPORT_INTERVAL = 1
+
+
+class LoadTable:
+    """
+    Load of every server process in shared memory. Each process writes its
+    own row, the load balancer reads them all.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        # No lock, a row is only written by its process (and bumped by the
+        # balancer between reports), a torn read only skews one placement
+        self.values = multiprocessing.Array("d", size * len(LOAD_FIELDS), lock=False)
+
+    def update(self, index: int, tunnels: int, connections: int, bytes_per_second: float, loop_lag: float):
+        start = index * len(LOAD_FIELDS)
+        self.values[start:start + len(LOAD_FIELDS)] = [tunnels, connections, bytes_per_second, loop_lag]
+
+    def add_tunnel(self, index: int):
+        # Count a tunnel sent to a process before it reports it itself
+        self.values[index * len(LOAD_FIELDS)] += 1
+
+    def get(self, index: int) -> dict:
+        start = index * len(LOAD_FIELDS)
+        return dict(zip(LOAD_FIELDS, self.values[start:start + len(LOAD_FIELDS)]))
+
+    def score(self, index: int) -> float:
+        start = index * len(LOAD_FIELDS)
+        row = self.values[start:start + len(LOAD_FIELDS)]
+        return sum(value * weight for value, weight in zip(row, LOAD_WEIGHTS))
+
+    def least_loaded(self) -> int:
+        return min(range(self.size), key=self.score)
+
+
+class LoadReporter:
+    # Samples the load of a server process into its LoadTable row, if it
+    # has one, and event loop lag into a histogram
+    def __init__(self, server, table: LoadTable = None, index: int = None, interval: float = LOAD_REPORT_INTERVAL):
+        self.server = server
+        self.table = table
+        self.index = index
+        self.interval = interval
+        self.task: asyncio.Task = None
+        self.loop_lag_histogram = Histogram()
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        last_bytes = self.server.bytes_relayed
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            elapsed = time.monotonic() - started
+
+            # Time the loop was too busy to wake us up on time
+            loop_lag = max(0.0, elapsed - self.interval)
+            self.loop_lag_histogram.observe(loop_lag)
+            relayed = self.server.bytes_relayed
+            if self.table is not None:
+                # Connections still setting up are no tunnels yet
+                tunnels = sum(1 for client in self.server.clients if client.forwarder)
+                self.table.update(
+                    self.index,
+                    tunnels,
+                    self.server.active_connections,
+                    (relayed - last_bytes) / elapsed,
+                    loop_lag,
+                )
+            last_bytes = relayed
@@ -0,0 +1,256 @@
+from exposehost.server.constants import *
+import asyncio
+import bisect
+import math
+import multiprocessing
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# Upper bounds of latency histograms, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Largest request head the metrics endpoint reads
+MAX_REQUEST_SIZE = 8 * 1024
+
+
+class Histogram:
+    # Distribution of observed values, counted per bucket upper bound
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)     # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> "Histogram":
+        copy = Histogram(self.buckets)
+        copy.counts = list(self.counts)
+        copy.sum = self.sum
+        copy.count = self.count
+        return copy
+
+
+class MetricFamily:
+    # Samples of one metric at collection time, values of a histogram
+    # family are Histogram snapshots
+    def __init__(self, name: str, metric_type: str, help_text: str):
+        self.name = name
+        self.type = metric_type
+        self.help = help_text
+        self.samples: list[tuple[dict, object]] = []
+
+    def add(self, value, **labels):
+        self.samples.append((labels, value))
+        return self
+
+
+def counter(name: str, help_text: str, value=None, **labels) -> MetricFamily:
+    family = MetricFamily(name, COUNTER, help_text)
+    return family.add(value, **labels) if value is not None else family
+
+
+def gauge(name: str, help_text: str, value=None, **labels) -> MetricFamily:
+    family = MetricFamily(name, GAUGE, help_text)
+    return family.add(value, **labels) if value is not None else family
+
+
+def histogram(name: str, help_text: str, value: Histogram = None, **labels) -> MetricFamily:
+    family = MetricFamily(name, HISTOGRAM, help_text)
+    return family.add(value.snapshot(), **labels) if value is not None else family
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                     for key, value in sorted(labels.items()))
+    return "{" + pairs + "}"
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(families: list[MetricFamily]) -> str:
+    # Prometheus text exposition format, families of the same name are merged
+    merged: dict[str, MetricFamily] = {}
+    for family in families:
+        if family.name in merged:
+            merged[family.name].samples.extend(family.samples)
+        else:
+            merged[family.name] = MetricFamily(family.name, family.type, family.help)
+            merged[family.name].samples = list(family.samples)
+
+    lines = []
+    for family in merged.values():
+        lines.append("# HELP %s %s" % (family.name, family.help))
+        lines.append("# TYPE %s %s" % (family.name, family.type))
+        for labels, value in family.samples:
+            if family.type != HISTOGRAM:
+                lines.append("%s%s %s" % (family.name, format_labels(labels), format_value(value)))
+                continue
+
+            cumulative = 0
+            for bound, count in zip(value.buckets + (math.inf,), value.counts):
+                cumulative += count
+                bucket_labels = dict(labels, le=format_value(bound))
+                lines.append("%s_bucket%s %s" % (family.name, format_labels(bucket_labels), cumulative))
+            lines.append("%s_sum%s %s" % (family.name, format_labels(labels), format_value(value.sum)))
+            lines.append("%s_count%s %s" % (family.name, format_labels(labels), value.count))
+    return "\n".join(lines) + "\n"
+
+
+def with_labels(families: list[MetricFamily], **labels) -> list[MetricFamily]:
+    # Copies of families with labels added to every sample
+    labelled = []
+    for family in families:
+        copy = MetricFamily(family.name, family.type, family.help)
+        copy.samples = [(dict(sample_labels, **labels), value) for sample_labels, value in family.samples]
+        labelled.append(copy)
+    return labelled
+
+
+def collect_server(server) -> list[MetricFamily]:
+    # Snapshot of a Server, read from the stats it keeps anyway. Only
+    # connections that got as far as a forwarder are tunnels
+    tunnels = [client for client in server.clients if client.forwarder]
+    tunnel_bytes_in = counter("exposehost_tunnel_bytes_in_total", "Bytes relayed from visitors to the client")
+    tunnel_bytes_out = counter("exposehost_tunnel_bytes_out_total", "Bytes relayed from the client to visitors")
+    for client in tunnels:
+        tunnel_bytes_in.add(client.bytes_in, tunnel=client.full_domain)
+        tunnel_bytes_out.add(client.bytes_out, tunnel=client.full_domain)
+
+    relay_memory = server.relay_memory.get_stats()
+    return [
+        gauge("exposehost_tunnels", "Tunnels connected", len(tunnels)),
+        gauge("exposehost_active_connections", "Visitor connections being relayed", server.active_connections),
+        gauge("exposehost_pending_connections", "Visitor connections waiting for the client to connect back",
+              len(PENDING_CONNECTIONS)),
+        tunnel_bytes_in,
+        tunnel_bytes_out,
+        counter("exposehost_bytes_relayed_total", "Bytes relayed by every tunnel", server.bytes_relayed),
+        gauge("exposehost_relay_buffered_bytes", "Bytes held in relay buffers and unsent data",
+              relay_memory["buffered"]),
+        counter("exposehost_pool_connections_total", "Tunneled connections by how the client connection was found",
+                server.pool_stats["hits"], source="pool").add(server.pool_stats["misses"], source="dial_back"),
+        histogram("exposehost_rendezvous_seconds", "Time for the client to connect back for a visitor",
+                  server.rendezvous_histogram),
+        counter("exposehost_rendezvous_timeouts_total", "Clients that did not connect back in time",
+                server.rendezvous_stats["timeouts"]),
+        histogram("exposehost_heartbeat_rtt_seconds", "Round trip time of answered heartbeats",
+                  server.liveness.rtt_histogram),
+        counter("exposehost_dead_tunnels_total", "Tunnels closed for not answering heartbeats",
+                server.liveness.stats["dead"]),
+        histogram("exposehost_nginx_reload_seconds", "Time taken by nginx reloads", server.nginx.reload_histogram),
+        histogram("exposehost_event_loop_lag_seconds", "Delay of the event loop waking up a timer",
+                  server.load_reporter.loop_lag_histogram),
+    ]
+
+
+class MetricsReporter:
+    # Sends the metrics of a server process to the MultiProcessingServer
+    def __init__(self, server, pipe, interval: float = METRICS_REPORT_INTERVAL):
+        self.server = server
+        self.pipe = pipe
+        self.interval = interval
+        self.task: asyncio.Task = None
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            families = collect_server(self.server)
+            try:
+                # A pipe the parent is slow to read from would block the loop
+                await loop.run_in_executor(None, self.pipe.send, families)
+            except OSError as e:
+                logger.error("Could not report metrics: %s", e)
+                return
+            await asyncio.sleep(self.interval)
+
+
+class MetricsAggregator:
+    # Latest metrics of every server process, read from their pipes
+    def __init__(self, pipes: list):
+        self.pipes = pipes
+        self.latest: dict[int, list[MetricFamily]] = {}
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        for index, pipe in enumerate(self.pipes):
+            loop.add_reader(pipe.fileno(), self.receive, index)
+
+    def receive(self, index: int):
+        pipe = self.pipes[index]
+        try:
+            self.latest[index] = pipe.recv()
+        except (EOFError, OSError):
+            # The server process is gone
+            asyncio.get_running_loop().remove_reader(pipe.fileno())
+            self.latest.pop(index, None)
+
+    def collect(self) -> list[MetricFamily]:
+        families = []
+        for index, worker_families in sorted(self.latest.items()):
+            families.extend(with_labels(worker_families, worker=index))
+        return families
+
+
+class MetricsEndpoint:
+    """
+    Serves the families returned by collect on GET /metrics, in the
+    Prometheus text format, from a minimal HTTP/1.0 server.
+    """
+
+    def __init__(self, collect, host: str, port: int):
+        self.collect = collect
+        self.host = host
+        self.port = port
+        self.server: asyncio.AbstractServer = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info("Metrics endpoint listening on %s:%s", self.host, self.port)
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), MAX_TIMEOUT)
+            request_line = head.split(b"\r\n", 1)[0].split(b" ")
+            if len(request_line) < 2 or len(head) > MAX_REQUEST_SIZE:
+                status, body = "400 Bad Request", b""
+            elif request_line[0] != b"GET" or request_line[1].split(b"?", 1)[0] != b"/metrics":
+                status, body = "404 Not Found", b""
+            else:
+                status, body = "200 OK", render(self.collect()).encode()
+
+            writer.write(("HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %s\r\nConnection: close\r\n\r\n"
+                          % (status, CONTENT_TYPE, len(body))).encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def worker_metrics_pipes(count: int) -> tuple[list, list]:
+    # One pipe per server process, the parent reads and the worker writes
+    pipes = [multiprocessing.Pipe(duplex=False) for _ in range(count)]
+    return [receive for receive, _ in pipes], [send for _, send in pipes]
@@ -0,0 +1,127 @@
+from exposehost.helpers import write_nginx_config, delete_nginx_config, write_nginx_route_map, restart_nginx
+from exposehost.server.constants import *
+from exposehost.server.metrics import Histogram
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import time
+
+
+class NginxManager:
+    """
+    Writes nginx configs and reloads nginx off the event loop. A single
+    worker thread runs the jobs one at a time and in order, so a config is
+    never removed before it was written and reloads never overlap.
+
+    Reloads are batched, changes made within `reload_window` seconds of the
+    first one are applied by a single reload, and every caller waits for
+    the reload covering its change.
+
+    In map routing mode tunnels are entries of a subdomain -> port map
+    instead of config files, the map is written once per batch.
+    """
+
+    executor: ThreadPoolExecutor = None
+    pending_reload: asyncio.Future = None      # resolved by the next batch reload
+    pending_changes: int = 0
+
+    def __init__(self, reload_window: float = NGINX_RELOAD_WINDOW, routing: str = NGINX_ROUTING_FILES,
+                 map_name: str = "default"):
+        if routing not in (NGINX_ROUTING_FILES, NGINX_ROUTING_MAP):
+            raise ValueError("Unknown nginx routing mode: %s" % routing)
+        self.reload_window = reload_window
+        self.routing = routing
+        # Name of the route map of this server process and its entries
+        self.map_name = map_name
+        self.routes: dict[str, int] = {}
+        self.reload_tasks: set[asyncio.Task] = set()
+        # Reloads done, how long they took in seconds and how many config
+        # changes they applied
+        self.reload_stats = {"reloads": 0, "reload_time_total": 0.0, "reload_time_max": 0.0,
+                             "changes": 0, "batch_size_max": 0}
+        self.reload_histogram = Histogram()
+
+    async def run(self, func, *args):
+        # Created on first use, servers are built before their process starts
+        if not self.executor:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nginx")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def timed_reload(self):
+        started = time.monotonic()
+        restart_nginx()
+        elapsed = time.monotonic() - started
+
+        # Only this thread updates the stats
+        self.reload_stats["reloads"] += 1
+        self.reload_stats["reload_time_total"] += elapsed
+        self.reload_stats["reload_time_max"] = max(self.reload_stats["reload_time_max"], elapsed)
+        self.reload_histogram.observe(elapsed)
+
+    async def reload(self):
+        # Wait for the batch reload covering the changes made so far
+        if self.pending_reload is None:
+            self.pending_reload = asyncio.get_running_loop().create_future()
+            self.pending_changes = 0
+            task = asyncio.create_task(self.reload_batch())
+            self.reload_tasks.add(task)
+            task.add_done_callback(self.reload_tasks.discard)
+        self.pending_changes += 1
+
+        # One waiter giving up must not cancel the reload for the others
+        await asyncio.shield(self.pending_reload)
+
+    async def reload_batch(self):
+        await asyncio.sleep(self.reload_window)
+
+        # Changes from now on go into the next batch
+        done = self.pending_reload
+        batch_size = self.pending_changes
+        self.pending_reload = None
+
+        try:
+            if self.routing == NGINX_ROUTING_MAP:
+                await self.run(write_nginx_route_map, self.map_name, dict(self.routes), DOMAIN_NAME)
+            await self.run(self.timed_reload)
+        except Exception as e:
+            done.set_exception(e)
+            return
+
+        self.reload_stats["changes"] += batch_size
+        self.reload_stats["batch_size_max"] = max(self.reload_stats["batch_size_max"], batch_size)
+        done.set_result(True)
+
+    async def add_config(self, full_domain: str, port: int):
+        if self.routing == NGINX_ROUTING_MAP:
+            self.routes[full_domain] = port
+        else:
+            await self.run(write_nginx_config, full_domain, port)
+        await self.reload()
+
+    async def remove_config(self, full_domain: str):
+        if self.routing == NGINX_ROUTING_MAP:
+            self.routes.pop(full_domain, None)
+            await self.reload()
+            return
+
+        try:
+            await self.run(delete_nginx_config, full_domain)
+        except OSError as e:
+            logger.error("Failed to remove nginx config of %s: %s", full_domain, e)
+            return
+        await self.reload()
+
+    async def start(self):
+        # Drop the routes a previous run of this server process left behind
+        if self.routing == NGINX_ROUTING_MAP:
+            await self.run(write_nginx_route_map, self.map_name, {}, DOMAIN_NAME)
+
+    def get_reload_stats(self) -> dict:
+        stats = dict(self.reload_stats)
+        stats["reload_time_avg"] = stats["reload_time_total"] / stats["reloads"] if stats["reloads"] else 0.0
+        stats["batch_size_avg"] = stats["changes"] / stats["reloads"] if stats["reloads"] else 0.0
+        return stats
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,105 @@
+from exposehost.server.constants import *
+import asyncio
+import time
+
+
+class TokenBucket:
+    # Refills at rate tokens per second up to burst, a take larger than what
+    # is left puts the bucket in debt and callers wait it off
+    rate: float = None
+    burst: float = None
+
+    def __init__(self, rate: float, burst: float = None):
+        if rate <= 0:
+            raise ValueError("Token bucket rate must be positive")
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount: float) -> float:
+        # Take amount tokens, returns the seconds until the bucket is out of debt
+        self.refill()
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def try_consume(self, amount: float = 1) -> bool:
+        # Take amount tokens only if they are all there
+        self.refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+
+class TunnelLimits:
+    # Limits of one tunnel, None leaves a rate unlimited
+    bytes_per_second: float = None
+    connections_per_second: float = None
+    weight: float = 1.0
+
+    def __init__(self, bytes_per_second: float = None, connections_per_second: float = None,
+                 weight: float = 1.0, connection_burst: float = None):
+        if weight <= 0:
+            raise ValueError("Tunnel weight must be positive")
+        if connection_burst is not None and connection_burst < 1:
+            raise ValueError("Connection burst must allow at least one connection")
+        self.bytes_per_second = bytes_per_second
+        self.connections_per_second = connections_per_second
+        self.weight = weight
+        # New connections accepted at once before the rate applies, by
+        # default a second worth of them and at least one
+        self.connection_burst = connection_burst
+
+
+DEFAULT_TUNNEL_LIMITS = TunnelLimits()
+
+
+class TunnelScheduler:
+    """
+    Shares the event loop of a Server between its tunnels. Relays of a
+    tunnel wait off its byte rate, and give the loop back to the other
+    tunnels after every quantum of bytes relayed without waiting, the
+    quantum scaling with the tunnel's weight. New visitor connections
+    beyond the connection rate are refused.
+    """
+
+    def __init__(self, limits: TunnelLimits = DEFAULT_TUNNEL_LIMITS, quantum: int = SCHEDULER_QUANTUM):
+        self.limits = limits
+        self.quantum = int(quantum * limits.weight)
+        self.byte_bucket = TokenBucket(limits.bytes_per_second) if limits.bytes_per_second else None
+        self.connection_bucket = None
+        if limits.connections_per_second:
+            burst = limits.connection_burst or max(limits.connections_per_second, 1)
+            self.connection_bucket = TokenBucket(limits.connections_per_second, burst)
+        self.unyielded = 0
+        self.stats = {"throttled_time": 0.0, "yields": 0, "connections_refused": 0}
+
+    def allow_connection(self) -> bool:
+        if self.connection_bucket and not self.connection_bucket.try_consume():
+            self.stats["connections_refused"] += 1
+            return False
+        return True
+
+    async def throttle(self, size: int):
+        # Called by the relays of the tunnel after every chunk
+        if self.byte_bucket:
+            wait = self.byte_bucket.consume(size)
+            if wait:
+                self.stats["throttled_time"] += wait
+                self.unyielded = 0
+                await asyncio.sleep(wait)
+                return
+
+        self.unyielded += size
+        if self.unyielded >= self.quantum:
+            self.unyielded = 0
+            self.stats["yields"] += 1
+            await asyncio.sleep(0)
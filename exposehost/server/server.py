@@ -1,10 +1,23 @@
 import asyncio
+import functools
 import logging
 import socket
 import ssl
 from exposehost.impl import packets
-from exposehost.helpers import clean_all_nginx_configs
+from exposehost.impl.relay import (RelayConfig, RelayMemory, RELAY_ENGINE_SOCKET, MIN_BUFFER_SIZE, MAX_BUFFER_SIZE,
+                                   WRITE_HIGH_WATER, WRITE_LOW_WATER, READER_LIMIT, SLOW_READER_PAUSE,
+                                   SLOW_READER_TIMEOUT, RELAY_MEMORY_LIMIT)
+from exposehost.helpers import clean_all_nginx_configs, clean_nginx_route_maps, new_event_loop
 from exposehost.server import ServerConnection
+from exposehost.server.liveness import LivenessManager
+from exposehost.server.load import LoadTable, LoadReporter
+from exposehost.server.nginx_manager import NginxManager
+from exposehost.server.http_router import HttpRouter
+from exposehost.server.sni_router import SniRouter
+from exposehost.server.domain_registry import DomainRegistry, registry_path
+from exposehost.server.scheduler import TunnelLimits, DEFAULT_TUNNEL_LIMITS
+from exposehost.server.metrics import (Histogram, MetricsReporter, MetricsAggregator, MetricsEndpoint,
+                                       collect_server, gauge, worker_metrics_pipes)
 from exposehost.server.constants import *
 from multiprocessing import Process
 import os
@@ -13,31 +26,135 @@ import os
 # Create SSL Context
 context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
 context.load_cert_chain('./exposehost/keys/test_certificate.pem', './exposehost/keys/test_private_key.pem')
+# Let clients resume their session on reconnects. The ticket keys are made
+# with the context, before MultiProcessingServer forks its workers, so a
+# ticket from one worker is accepted by all of them
+context.options &= ~ssl.OP_NO_TICKET
+context.num_tickets = TLS_SESSION_TICKETS
+
+
+async def recv_first_packet(handler: packets.ProtocolHandler) -> packets.Packet:
+    # First packet of a new connection, None once the connection is closed
+    # because it could not be read
+    try:
+        return await handler.recv_packet()
+    except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError, KeyError, ValueError) as e:
+        logger.debug("Closing connection without a valid first packet: %s", e)
+    handler.writer.close()
+    return None
 
 
 class Server(packets.ProtocolHandler):
     sock4: socket.socket = None
     ssock4: socket.socket = None
+    shared_sock4: socket.socket = None
     host: str = None
     port: int = None
+    shared_port: int = None
     protocol: str = None
     clients: list[ServerConnection] = [] 
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, relay_engine=RELAY_ENGINE_SOCKET,
+                 relay_min_buffer=MIN_BUFFER_SIZE, relay_max_buffer=MAX_BUFFER_SIZE,
+                 relay_high_water=WRITE_HIGH_WATER, relay_low_water=WRITE_LOW_WATER,
+                 relay_reader_limit=READER_LIMIT, slow_reader=SLOW_READER_PAUSE,
+                 slow_reader_timeout=SLOW_READER_TIMEOUT, relay_memory_limit=RELAY_MEMORY_LIMIT,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, dead_peer_deadline=DEAD_PEER_DEADLINE,
+                 use_uvloop=True, shared_port=None, load_table: LoadTable = None, load_index: int = None,
+                 nginx_reload_window=NGINX_RELOAD_WINDOW, nginx_routing=NGINX_ROUTING_FILES,
+                 http_router_port=None, https_router_port=None, tls_router_port=None,
+                 domain_registry: DomainRegistry = None, tunnel_limits: dict[str, TunnelLimits] = None,
+                 default_tunnel_limits: TunnelLimits = DEFAULT_TUNNEL_LIMITS,
+                 metrics_port=None, metrics_pipe=None):
         self.host = host
         self.port = port
+        # Port also bound by the other server processes with SO_REUSEPORT,
+        # port stays private to this process for connections that must
+        # reach it (pooled and dial-back connections)
+        self.shared_port = shared_port
+        # Run on uvloop when it is installed, False forces the stdlib loop
+        self.use_uvloop = use_uvloop
+        # How visitor connections to the exposed ports are relayed
+        self.relay_engine = relay_engine
+        # Limits of the adaptive relay buffers, passed on to each forwarder
+        self.relay_min_buffer = relay_min_buffer
+        self.relay_max_buffer = relay_max_buffer
+        # Memory held by the relays of this process, capped at relay_memory_limit
+        self.relay_memory = RelayMemory(relay_memory_limit)
+        self.relay_config = RelayConfig(relay_min_buffer, relay_max_buffer, relay_high_water, relay_low_water,
+                                        relay_reader_limit, slow_reader, slow_reader_timeout, self.relay_memory)
+        # ServerConnection by client session key, for pooled connections
+        self.sessions: dict[str, ServerConnection] = {}
+        # Tunneled connections served by a pooled connection (hits) or
+        # by asking the client to connect back (misses)
+        self.pool_stats = {"hits": 0, "misses": 0}
+        # Clients connecting back for a tunneled connection, in seconds
+        self.rendezvous_stats = {"connections": 0, "timeouts": 0, "latency_total": 0.0, "latency_max": 0.0}
+        self.rendezvous_histogram = Histogram()
+        # Heartbeats and dead peer detection for every tunnel of this server
+        self.liveness = LivenessManager(heartbeat_interval, dead_peer_deadline)
+        # Config writes and reloads of nginx for http tunnels
+        self.nginx = NginxManager(nginx_reload_window, nginx_routing, map_name="server-%s" % port)
+        # Rate limits and loop share of tunnels by subdomain, applied when
+        # the tunnel registers, default_tunnel_limits for any other
+        self.tunnel_limits: dict[str, TunnelLimits] = dict(tunnel_limits or {})
+        self.default_tunnel_limits = default_tunnel_limits
+        # Subdomains claimed by tunnels, shared with the other server
+        # processes or private to this one when not given
+        self.domain_registry = domain_registry if domain_registry is not None else DomainRegistry()
+        # http tunnels by full domain, for the built-in routers
+        self.domains: dict[str, ServerConnection] = {}
+        # Built-in http(s) routers replacing nginx, when given a port
+        self.routers: list[HttpRouter] = []
+        if http_router_port is not None:
+            self.routers.append(HttpRouter(self, host, http_router_port))
+        if https_router_port is not None:
+            self.routers.append(HttpRouter(self, host, https_router_port, ssl_context=context))
+        # Shared listener of tls tunnels, routed by SNI without terminating TLS
+        self.sni_router = None
+        if tls_router_port is not None:
+            self.sni_router = SniRouter(self, host, tls_router_port)
+        # Visitor connections being forwarded and bytes relayed by them
+        self.active_connections = 0
+        self.bytes_relayed = 0
+        # Row of the load balancer's LoadTable this server reports to, if
+        # any, and event loop lag
+        self.load_reporter = LoadReporter(self, load_table, load_index)
+        # Metrics served on metrics_port and/or sent to the parent process
+        # over metrics_pipe, both collected from the stats above
+        self.metrics_port = metrics_port
+        self.metrics_endpoint = None
+        self.metrics_reporter = None
+        if metrics_pipe is not None:
+            self.metrics_reporter = MetricsReporter(self, metrics_pipe)
         logger.info("Starting listener on %s:%s", host, port)
 
-    async def handleAsyncConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        super().__init__(reader, writer)
+    async def handleAsyncConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, shared: bool = False):
+        # Connections are handled concurrently, each gets its own handler
+        handler = packets.ProtocolHandler(reader, writer)
 
         logging.debug("Received new connection.")
 
         # Receive the packet
-        packet = await self.recv_packet()
+        packet = await recv_first_packet(handler)
+        if packet is None:
+            return
 
         logger.debug("Received Packet: %s", packet.packet_json)
 
+        if shared and isinstance(packet, packets.TunnelRequestPacket) and not packet.multiplex:
+            # The client will connect back for each tunneled connection and
+            # the kernel could hand those to any process, move the tunnel
+            # to our private port
+            loadbalance_resp_packet = packets.LoadbalanceResponsePacket()
+            loadbalance_resp_packet.new_port = self.port
+
+            logger.debug("Sent client without multiplexing to port: %s", self.port)
+            await handler.send_packet(loadbalance_resp_packet)
+            writer.close()
+            await writer.wait_closed()
+            return
+
         if isinstance(packet, packets.TunnelRequestPacket):
             server_connection = ServerConnection(
                 packet.subdomain,
@@ -46,25 +163,33 @@ class Server(packets.ProtocolHandler):
                 packet.port,
                 reader,
                 writer,
-                self
+                self,
+                multiplex=packet.multiplex,
+                codecs=packet.codecs,
+                heartbeat_ack=packet.heartbeat_ack
             )
 
             self.clients.append(server_connection)
             await server_connection.start_control_server()
             return
 
+        if isinstance(packet, packets.PooledConnectionPacket):
+            server_connection = self.sessions.get(packet.c_session_key)
+            if server_connection and not server_connection.is_killed:
+                # Keep the connection idle until a tunneled connection needs it
+                server_connection.add_pooled_connection(reader, writer, packet.max_idle)
+                return
+
         if isinstance(packet, packets.NewConnectionHostResponsePacket):
-            for control_server in self.clients:
-                for forwarder in control_server.forwarders:
-                    for client in forwarder.tcp_servers:
-                       if client.connection_id == packet.connection_id:
-                           # Received connection request
-                           # set_host_connection will send byte 0x01 to
-                           # indicate server has been set
-                           # after that, all the data from the clients will
-                           # be forwarded
-                           await client.set_host_connection(reader, writer)
-                           return
+            client = PENDING_CONNECTIONS.get(packet.connection_id)
+            if client:
+                # Received connection request
+                # set_host_connection will send byte 0x01 to
+                # indicate server has been set
+                # after that, all the data from the clients will
+                # be forwarded
+                await client.set_host_connection(reader, writer)
+                return
 
         # If the packet received is invalid
         # or client is not found, close the connection
@@ -72,37 +197,108 @@ class Server(packets.ProtocolHandler):
         await writer.wait_closed()
         return
 
+    def get_tunnel_limits(self, subdomain: str) -> TunnelLimits:
+        return self.tunnel_limits.get(subdomain, self.default_tunnel_limits)
+
+    def set_tunnel_limits(self, subdomain: str, limits: TunnelLimits):
+        # Used by the next tunnel registering subdomain
+        self.tunnel_limits[subdomain] = limits
+
+    def get_scheduler_stats(self) -> dict:
+        # throttled_time: seconds relays waited off the byte rate
+        # yields: times the loop was given back after a quantum
+        # connections_refused: visitor connections over the connection rate
+        return {client.subdomain: dict(client.forwarder.scheduler.stats)
+                for client in self.clients if client.forwarder}
+
+    def get_relay_memory_stats(self) -> dict:
+        # Bytes buffered by the relays of this process, see RelayMemory
+        return self.relay_memory.get_stats()
+
+    def get_tls_stats(self) -> dict:
+        # accepted: TLS handshakes completed, resumed: of those, resumed
+        # sessions. Counted per process, shared by every listener
+        stats = context.session_stats()
+        return {"accepted": stats["accept_good"], "resumed": stats["hits"]}
+
+    def create_listener(self, port: int, reuse_port: bool = False) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Every process binding the port gets its own accept queue
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, port))
+        sock.listen(5)
+        sock.setblocking(False)
+        return sock
+
     async def startAsync(self):
 
         # Create new SSL Socket
-        self.sock4 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock4.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock4.bind((self.host, self.port))
-        self.sock4.listen(5)
-        self.sock4.setblocking(False)
+        self.sock4 = self.create_listener(self.port)
 
         logger.info("Starting TCP Server Listener at %s", self.port)
+        self.liveness.start()
+        self.load_reporter.start()
+        if self.metrics_reporter:
+            self.metrics_reporter.start()
+        if self.metrics_port is not None:
+            self.metrics_endpoint = MetricsEndpoint(lambda: collect_server(self), METRICS_HOST, self.metrics_port)
+            await self.metrics_endpoint.start()
+        if self.sni_router:
+            await self.sni_router.start()
+        if self.routers:
+            for router in self.routers:
+                await router.start()
+        else:
+            await self.nginx.start()
 
         await asyncio.start_server(self.handleAsyncConnection, sock=self.sock4, ssl=context)
 
+        if self.shared_port is not None:
+            self.shared_sock4 = self.create_listener(self.shared_port, reuse_port=True)
+            logger.info("Starting shared TCP Server Listener at %s", self.shared_port)
+            await asyncio.start_server(
+                functools.partial(self.handleAsyncConnection, shared=True),
+                sock=self.shared_sock4, ssl=context)
+
     def start(self):
-        # Clean existing nginx configs on startup
-        clean_all_nginx_configs()
+        # Clean existing nginx configs on startup, unless the built-in
+        # routers replace nginx
+        if not self.routers:
+            clean_all_nginx_configs()
 
-        loop = asyncio.new_event_loop()
+        loop = new_event_loop(self.use_uvloop)
         loop.run_until_complete(self.startAsync())
         loop.run_forever()
 
 
 class MultiProcessingServer(packets.ProtocolHandler):
-    servers: dict[Server, int] = {}
+    servers: list[Server] = []
+    load_table: LoadTable = None
+    domain_registry: DomainRegistry = None
     process_list: list[Process] = []
+    metrics_pipes: list = []
     host = None
     port = None
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, use_uvloop=True, reuse_port=False, nginx_routing=NGINX_ROUTING_FILES,
+                 metrics_port=None):
         self.host = host
         self.port = port
+        # Used by the load balancer and every server process
+        self.use_uvloop = use_uvloop
+        self.nginx_routing = nginx_routing
+        # Server processes accept on port themselves with SO_REUSEPORT
+        # instead of a load balancer redirecting clients to them
+        if reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+            raise ValueError("SO_REUSEPORT is not supported on this platform")
+        self.reuse_port = reuse_port
+        # Metrics of every server process, labelled by worker, are served
+        # here by the parent process
+        self.metrics_port = metrics_port
+        self.metrics_aggregator = None
+        self.metrics_endpoint = None
 
     def create_servers(self, no_of_servers = 0):
         thread_count = os.cpu_count()
@@ -113,10 +309,27 @@ class MultiProcessingServer(packets.ProtocolHandler):
         else:
             server_count = no_of_servers
         
+        # Server processes report their load here
+        self.load_table = LoadTable(server_count)
+        # Subdomains are claimed here by every server process, leftovers of
+        # an earlier run are dropped
+        self.domain_registry = DomainRegistry(registry_path(self.port))
+        self.domain_registry.reset()
+        self.domain_registry.close()
+        # Same for the nginx route maps of server processes
+        clean_nginx_route_maps()
+        # Server processes send their metrics snapshots over these
+        send_pipes = [None] * server_count
+        if self.metrics_port is not None:
+            self.metrics_pipes, send_pipes = worker_metrics_pipes(server_count)
+
         for i in range(1, server_count+1):
-            server = Server(self.host, port=self.port+i)
-            # Initialize with 0 count
-            self.servers[server] = 0
+            server = Server(self.host, port=self.port+i, use_uvloop=self.use_uvloop,
+                            shared_port=self.port if self.reuse_port else None,
+                            load_table=self.load_table, load_index=i-1,
+                            nginx_routing=self.nginx_routing, domain_registry=self.domain_registry,
+                            metrics_pipe=send_pipes[i-1])
+            self.servers.append(server)
 
     
     def start_servers(self):
@@ -124,6 +337,12 @@ class MultiProcessingServer(packets.ProtocolHandler):
             p = Process(target = server.start)
             p.start()
             self.process_list.append(p)
+
+        # The write ends now belong to the server processes, the parent
+        # sees EOF once a process is gone
+        for server in self.servers:
+            if server.metrics_reporter:
+                server.metrics_reporter.pipe.close()
         
         print("Started: " + str(len(self.servers)) + "servers")
 
@@ -131,35 +350,52 @@ class MultiProcessingServer(packets.ProtocolHandler):
         # self.process_list[0].join()
 
 
-    def get_least_loaded_server(self):
-        sorted_servers = sorted(self.servers.items(), key=lambda item: item[1])
-        least_used_server = sorted_servers[0][0]
+    def get_least_loaded_server(self) -> Server:
+        index = self.load_table.least_loaded()
+        # Counted until the server reports the tunnel itself
+        self.load_table.add_tunnel(index)
+        return self.servers[index]
+
+    def get_server_loads(self) -> list[dict]:
+        return [self.load_table.get(index) for index in range(len(self.servers))]
 
-        return least_used_server
+    def collect_metrics(self) -> list:
+        # Latest snapshots of the server processes and their load scores as
+        # seen by the load balancer
+        load_score = gauge("exposehost_worker_load_score", "Load score the load balancer picks server processes by")
+        for index in range(len(self.servers)):
+            load_score.add(self.load_table.score(index), worker=index)
+        return self.metrics_aggregator.collect() + [load_score]
+
+    async def start_metrics(self):
+        self.metrics_aggregator = MetricsAggregator(self.metrics_pipes)
+        self.metrics_aggregator.start()
+        self.metrics_endpoint = MetricsEndpoint(self.collect_metrics, METRICS_HOST, self.metrics_port)
+        await self.metrics_endpoint.start()
 
 
     async def handleAsyncConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        super().__init__(reader, writer)
+        handler = packets.ProtocolHandler(reader, writer)
 
         logging.debug("LoadBalancer: Received new connection.")
 
         # Receive the packet
-        packet = await self.recv_packet()
+        packet = await recv_first_packet(handler)
+        if packet is None:
+            return
 
         logger.debug("Received Packet: %s", packet.packet_json)
 
         if isinstance(packet, packets.TunnelRequestPacket):
             least_used_server = self.get_least_loaded_server()
 
-            self.servers[least_used_server] += 1
-
             loadbalance_resp_packet = packets.LoadbalanceResponsePacket()
             loadbalance_resp_packet.new_port = least_used_server.port
 
             logger.debug("Sent loadbalanced packet for port: %s", loadbalance_resp_packet.new_port)
-            await self.send_packet(loadbalance_resp_packet)
+            await handler.send_packet(loadbalance_resp_packet)
 
-            await self.close()
+            await handler.close()
             return
 
         # If the packet received is invalid
@@ -181,14 +417,24 @@ class MultiProcessingServer(packets.ProtocolHandler):
 
 
     def start(self):
-        logger.info("Starting loadbalancer listener at %s", self.port)
-        
         # Create server objects
         self.create_servers()
 
         # Start all servers
         self.start_servers()
 
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(self.startAsync())
+        loop = new_event_loop(self.use_uvloop)
+        if self.metrics_port is not None:
+            loop.run_until_complete(self.start_metrics())
+
+        if self.reuse_port:
+            # Server processes share the port, nothing to balance here
+            logger.info("Server processes sharing port %s", self.port)
+            if self.metrics_port is None:
+                for p in self.process_list:
+                    p.join()
+                return
+        else:
+            logger.info("Starting loadbalancer listener at %s", self.port)
+            loop.run_until_complete(self.startAsync())
         loop.run_forever()
@@ -1,8 +1,35 @@
 from exposehost.impl import packets 
+from exposehost.impl.multiplex import Multiplexer
 from exposehost.server import ExposeHostForwarder
-from exposehost.helpers import remove_old_nginx_config, add_new_nginx_config
+from exposehost.server.liveness import TunnelLiveness
 from exposehost.server.constants import *
 import asyncio
+import collections
+import ssl
+import time
+
+
+class PooledConnection:
+    # Idle connection opened in advance by the client for future tunneled connections
+    reader: asyncio.StreamReader = None
+    writer: asyncio.StreamWriter = None
+    expires_at: float = None
+    watch_task: asyncio.Task = None
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, expires_at: float):
+        self.reader = reader
+        self.writer = writer
+        self.expires_at = expires_at
+
+    def is_usable(self) -> bool:
+        return not self.writer.is_closing() and time.monotonic() < self.expires_at
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception as e:
+            logger.debug("Error while closing pooled connection: %s", e)
 
 
 class ServerConnection(packets.ProtocolHandler):
@@ -14,13 +41,27 @@ class ServerConnection(packets.ProtocolHandler):
     protocol: str = None                       # for now http/tcp
     exposed_port: int = 0                      # port to be exposed
     serverClassInstance = None
+    multiplex: bool = False                    # client asked for multiplexed streams
+    multiplexer: Multiplexer = None
+    codecs: str = packets.CODEC_JSON           # codecs offered by the client
+    is_killed: bool = False
+    heartbeat_ack: bool = False                # client answers heartbeats
+    liveness: TunnelLiveness = None
+    forwarder: ExposeHostForwarder = None      # forwarder of this tunnel
+    forwarder_port: int = None                 # its port, None if it does not listen
+    bytes_in: int = 0                          # relayed from visitors to the client
+    bytes_out: int = 0                         # relayed from the client to visitors
 
-    def __init__(self, subdomain: str, c_session_key: str, protocol: str, exposed_port: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, serverClassInstance):
+    def __init__(self, subdomain: str, c_session_key: str, protocol: str, exposed_port: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, serverClassInstance, multiplex: bool = False, codecs: str = packets.CODEC_JSON, heartbeat_ack: bool = False):
         self.subdomain = subdomain
         self.c_session_key = c_session_key
         self.protocol = protocol
         self.exposed_port = exposed_port
         self.serverClassInstance = serverClassInstance
+        self.multiplex = multiplex
+        self.codecs = codecs
+        self.heartbeat_ack = heartbeat_ack
+        self.idle_connections: collections.deque[PooledConnection] = collections.deque()
         super().__init__(reader, writer)
 
 
@@ -36,32 +77,83 @@ class ServerConnection(packets.ProtocolHandler):
             await self.kill_server("Connection closed by client")
 
     
-    async def heartbeat_check(self, exposed_server_port):
-        while True:
-            heartbeatPacket = packets.HeartBeatPacket()
-            response = await self.send_packet(heartbeatPacket)
-            
-            if response == False:
-                logger.debug("Sent heartbeat packet to: %s, response: %s", self.subdomain, response)
-
-                # False response means connection was closed, stop forwarder that uses
-                # exposed_server_port
-                print(self.forwarders, self.forwarders_port_mapping)
-                forwarder = self.forwarders_port_mapping.get(exposed_server_port)
-                if forwarder:
-                    logger.debug("Stopping forwarder at port: %s", exposed_server_port)
-                    await forwarder.stop_server()
-                    print("Remaining forwarders: ", self.forwarders)
-                    self.forwarders_port_mapping.pop(exposed_server_port)
-
-                # Also stop the server connection
-                await self.kill_server("Connection closed during heartbeat check")
-
-                return 
-            await asyncio.sleep(5)   # wait for 5 seconds
-    
+    def count_bytes_in(self, size: int):
+        self.bytes_in += size
+        self.serverClassInstance.bytes_relayed += size
+
+    def count_bytes_out(self, size: int):
+        self.bytes_out += size
+        self.serverClassInstance.bytes_relayed += size
+
+    def add_pooled_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, max_idle: int):
+        pooled = PooledConnection(reader, writer, time.monotonic() + max_idle - POOL_EXPIRY_MARGIN)
+        pooled.watch_task = asyncio.create_task(self.watch_pooled_connection(pooled))
+        self.idle_connections.append(pooled)
+
+    async def watch_pooled_connection(self, pooled: PooledConnection):
+        # Client sends nothing on an idle connection, any read result
+        # means it was closed. Cancelled when the connection is handed out
+        await pooled.reader.read(1)
+        if pooled in self.idle_connections:
+            self.idle_connections.remove(pooled)
+        await pooled.close()
+
+    async def take_pooled_connection(self, connection_id: str):
+        # Returns reader, writer of an idle pooled connection that has been
+        # told about connection_id, or None if the pool is empty
+        pool_stats = self.serverClassInstance.pool_stats
+        while self.idle_connections:
+            pooled = self.idle_connections.popleft()
+            pooled.watch_task.cancel()
+
+            if not pooled.is_usable():
+                await pooled.close()
+                continue
+
+            connection_packet = packets.NewClientConnectionPacket()
+            connection_packet.connection_id = connection_id
+            connection_packet.c_session_key = self.c_session_key
+
+            pooled_handler = packets.ProtocolHandler(pooled.reader, pooled.writer)
+            pooled_handler.codec = self.codec
+            if not await pooled_handler.send_packet(connection_packet):
+                await pooled.close()
+                continue
+
+            pool_stats["hits"] += 1
+            return pooled.reader, pooled.writer
+
+        pool_stats["misses"] += 1
+        return None
+
+    async def control_loop(self):
+        # Read what the client sends on the control connection, heartbeat
+        # answers and stream frames of a multiplexed tunnel
+        try:
+            while True:
+                packet = await self.recv_packet()
+                if isinstance(packet, packets.HeartBeatAckPacket):
+                    self.serverClassInstance.liveness.acked(self.liveness)
+                    continue
+
+                self.liveness.seen()
+                if self.multiplexer:
+                    self.multiplexer.handle_packet(packet)
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError) as e:
+            logger.debug("Control connection of %s closed: %s", self.full_domain, e)
+        except KeyError as e:
+            # recv_packet does not know the packet id, the stream is out of sync
+            logger.warning("Unknown packet %s on control connection of %s", e, self.full_domain)
+        finally:
+            if self.multiplexer:
+                self.multiplexer.close_all()
+            await self.kill_server("Control connection closed")
 
     async def kill_server(self, reason: str):
+        if self.is_killed:
+            return
+        self.is_killed = True
+
         kill_connection_packet = packets.KillServerConnectionPacket()
         kill_connection_packet.reason = reason
 
@@ -70,15 +162,49 @@ class ServerConnection(packets.ProtocolHandler):
         
         # Remove Server Connection from Server Class Instance
         self.serverClassInstance.clients.remove(self)
+        self.serverClassInstance.sessions.pop(self.c_session_key, None)
+        self.serverClassInstance.liveness.unregister(self, self.liveness)
+
+        # Stop the forwarder of this tunnel
+        if self.forwarder:
+            logger.debug("Stopping forwarder at port: %s", self.forwarder_port)
+            self.forwarders_port_mapping.pop(self.forwarder_port, None)
+            await self.forwarder.stop_server()
+
+        # Drop the idle connections kept by the client
+        while self.idle_connections:
+            pooled = self.idle_connections.popleft()
+            pooled.watch_task.cancel()
+            await pooled.close()
+
+        if self.protocol == "tls":
+            self.serverClassInstance.domains.pop(self.full_domain, None)
 
         # If protocol is http then just remove the nginx config
         if self.protocol == "http":
-            remove_old_nginx_config(self.full_domain)
-            CURRENT_DOMAINS.remove(self.full_domain)
+            self.serverClassInstance.domains.pop(self.full_domain, None)
+            if not self.serverClassInstance.routers:
+                await self.serverClassInstance.nginx.remove_config(self.full_domain)
 
-        # Close the Connection
-        await self.close()
+        # Let any server process hand out the subdomain again
+        await self.serverClassInstance.domain_registry.release(self.full_domain)
 
+        # Close the Connection, it may already be torn down by the client
+        try:
+            await self.close()
+        except (ConnectionError, ssl.SSLError) as e:
+            logger.debug("Error while closing control connection of %s: %s", self.full_domain, e)
+
+
+    async def refuse(self, tunnel_response_packet: packets.TunnelResponsePacket, error: str):
+        # Tell the client why its tunnel was not set up, the connection is
+        # no tunnel of this server
+        tunnel_response_packet.status = "error"
+        tunnel_response_packet.error = error
+        await self.send_packet(tunnel_response_packet)
+        if self in self.serverClassInstance.clients:
+            self.serverClassInstance.clients.remove(self)
+        await self.close()
 
     async def start_control_server(self):
         # Things to do here:
@@ -87,41 +213,75 @@ class ServerConnection(packets.ProtocolHandler):
         # Validate auth
         # Do checks and validation of received info
 
-        forwarder_instance = ExposeHostForwarder(self, self.protocol, 0) 
+        server = self.serverClassInstance
+        forwarder_instance = ExposeHostForwarder(self, self.protocol, 0, server.relay_engine, server.relay_config,
+                                                 server.get_tunnel_limits(self.subdomain))
         tunnel_response_packet = packets.TunnelResponsePacket()
         
         self.full_domain = self.subdomain + "." + DOMAIN_NAME
 
-        if self.full_domain in CURRENT_DOMAINS:
-            tunnel_response_packet.status = "error"
-            tunnel_response_packet.error = "Subdomain already in use"
-            await self.send_packet(tunnel_response_packet)
-            await self.close()
+        if self.protocol == "tls" and not server.sni_router:
+            await self.refuse(tunnel_response_packet, "TLS tunnels are not enabled on this server")
             return
-        
-        CURRENT_DOMAINS.add(self.full_domain)
 
-        # Start the forwarder server
-        exposed_server = await forwarder_instance.startExposedServer()
-        exposed_port = exposed_server[1]
+        # Claimed in the registry shared by every server process, so the
+        # subdomain is unique across all of them
+        if not await server.domain_registry.claim(self.full_domain):
+            await self.refuse(tunnel_response_packet, "Subdomain already in use")
+            return
+
+        if self.multiplex:
+            # Tunneled connections will be opened as streams on this connection
+            self.multiplexer = Multiplexer(self, self.serverClassInstance.relay_memory)
+            tunnel_response_packet.multiplex = True
 
-        # Append the forwarder with exposed_port as key
         self.forwarders.append(forwarder_instance)
-        self.forwarders_port_mapping[exposed_port] = forwarder_instance
+        self.forwarder = forwarder_instance
+
+        if self.protocol == "tls":
+            # Visitors reach the tunnel through the shared SNI router
+            exposed_port = server.sni_router.port
+        else:
+            # Start the forwarder server
+            exposed_server = await forwarder_instance.startExposedServer()
+            exposed_port = exposed_server[1]
+
+            # Append the forwarder with exposed_port as key
+            self.forwarders_port_mapping[exposed_port] = forwarder_instance
+            self.forwarder_port = exposed_port
 
         tunnel_response_packet.status = "success"
+        tunnel_response_packet.pooling = True
+        tunnel_response_packet.heartbeat_ack = self.heartbeat_ack
         tunnel_response_packet.port = exposed_port
         tunnel_response_packet.url = self.full_domain
 
+        if self.protocol == "tls":
+            self.serverClassInstance.domains[self.full_domain] = self
+
         if self.protocol == "http":
-            # Add nginx config if protocol is http
-            # add_new_nginx_config restarts nginx internally
-            add_new_nginx_config(self.full_domain, exposed_port)
+            self.serverClassInstance.domains[self.full_domain] = self
+            # Add nginx config if protocol is http and the server has no
+            # router of its own, the config is written and nginx reloaded
+            # off the event loop
+            if not self.serverClassInstance.routers:
+                await self.serverClassInstance.nginx.add_config(self.full_domain, exposed_port)
             tunnel_response_packet.url = "https://" + self.full_domain
 
-        # Send successful tunnel resp
+        # Pooled connections from the client are matched by session key
+        self.serverClassInstance.sessions[self.c_session_key] = self
+
+        # Use the first codec offered by the client that we support
+        for codec in self.codecs.split(","):
+            if codec in packets.SUPPORTED_CODECS:
+                tunnel_response_packet.selected_codec = codec
+                break
+
+        # Send successful tunnel resp, later packets use the selected codec
         await self.send_packet(tunnel_response_packet)
+        self.codec = tunnel_response_packet.selected_codec
         logger.debug("Sent tunnel response packet for %s", self.full_domain)
         
-        # Start the heartbeat check task, schedule background task
-        heartbeat_packet_task = asyncio.create_task(self.heartbeat_check(exposed_port))
\ No newline at end of file
+        # Heartbeats are sent by the liveness manager of the server
+        self.liveness = self.serverClassInstance.liveness.register(self)
+        self.control_loop_task = asyncio.create_task(self.control_loop())
@@ -0,0 +1,111 @@
+from exposehost.server.constants import *
+import asyncio
+import struct
+
+TLS_HANDSHAKE_RECORD = 0x16
+TLS_CLIENT_HELLO = 0x01
+SNI_EXTENSION = 0x0000
+SNI_HOST_NAME = 0x00
+# Largest TLS record, a ClientHello has to fit in the first one
+MAX_RECORD_SIZE = 16384 + 2048
+
+
+class SniRouter:
+    """
+    Shared listener for tls tunnels. Peeks the server name of the
+    ClientHello and relays the raw bytes, starting with the ClientHello,
+    to the matching tunnel. TLS is terminated by the client's service, and
+    tls tunnels need no listening socket of their own.
+    """
+    server_socket: asyncio.Server = None
+
+    def __init__(self, serverClassInstance, host: str, port: int):
+        self.serverClassInstance = serverClassInstance
+        self.host = host
+        self.port = port
+        self.stats = {"routed": 0, "not_found": 0, "bad_hellos": 0}
+
+    async def start(self):
+        self.server_socket = await asyncio.start_server(self.handle_connection, self.host, self.port, backlog=100)
+        self.port = self.server_socket.sockets[0].getsockname()[1]
+        logger.info("SNI router listening on %s:%s", self.host, self.port)
+        return self.port
+
+    async def stop(self):
+        if self.server_socket:
+            self.server_socket.close()
+            await self.server_socket.wait_closed()
+
+    async def read_client_hello(self, reader: asyncio.StreamReader) -> bytes:
+        # Returns the first TLS record, raises ValueError if it is not a handshake
+        header = await reader.readexactly(5)
+        record_type, _, length = struct.unpack("!BHH", header)
+        if record_type != TLS_HANDSHAKE_RECORD or length > MAX_RECORD_SIZE:
+            raise ValueError("Not a TLS handshake record")
+        return header + await reader.readexactly(length)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            record = await asyncio.wait_for(self.read_client_hello(reader), MAX_TIMEOUT)
+            server_name = parse_sni(record)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError) as e:
+            logger.debug("Dropping TLS connection without a usable ClientHello: %s", e)
+            self.stats["bad_hellos"] += 1
+            writer.close()
+            return
+
+        server_connection = self.serverClassInstance.domains.get(server_name)
+        if not server_connection or server_connection.protocol != "tls" or not server_connection.forwarder:
+            # No way to answer without a certificate for the name, just close
+            self.stats["not_found"] += 1
+            writer.close()
+            return
+
+        self.stats["routed"] += 1
+        await server_connection.forwarder.handleTCPClientConnection(reader, writer, initial_data=record)
+
+
+def parse_sni(record: bytes) -> str:
+    """
+    Server name of a TLS record holding a ClientHello, None if it has no
+    server name extension. Raises ValueError if the ClientHello is malformed.
+    """
+    try:
+        offset = 5
+        handshake_type = record[offset]
+        if handshake_type != TLS_CLIENT_HELLO:
+            raise ValueError("Not a ClientHello")
+        # handshake type, length, client version, random
+        offset += 1 + 3 + 2 + 32
+
+        session_id_length = record[offset]
+        offset += 1 + session_id_length
+        (cipher_suites_length,) = struct.unpack_from("!H", record, offset)
+        offset += 2 + cipher_suites_length
+        compression_methods_length = record[offset]
+        offset += 1 + compression_methods_length
+
+        if offset == len(record):
+            return None
+        (extensions_length,) = struct.unpack_from("!H", record, offset)
+        offset += 2
+        extensions_end = min(offset + extensions_length, len(record))
+
+        while offset + 4 <= extensions_end:
+            extension_type, extension_length = struct.unpack_from("!HH", record, offset)
+            offset += 4
+            if extension_type == SNI_EXTENSION:
+                # server name list length, then (type, length, name) entries
+                position = offset + 2
+                end = offset + extension_length
+                while position + 3 <= end:
+                    name_type, name_length = struct.unpack_from("!BH", record, position)
+                    position += 3
+                    if name_type == SNI_HOST_NAME:
+                        return record[position:position + name_length].decode("ascii").lower()
+                    position += name_length
+                return None
+            offset += extension_length
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise ValueError("Malformed ClientHello: %s" % e)
+    return None
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import ssl
+
+from exposehost.impl import packets
+from exposehost.impl.multiplex import Multiplexer, STREAM_WINDOW_SIZE, MAX_FRAME_SIZE
+from exposehost.impl.relay import RelayMemory
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def decode(packet: packets.Packet) -> packets.Packet:
+    # Round trip a packet through the wire format
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(packets.ProtocolHandler(None, None).encode_packet(packet))
+        return await packets.ProtocolHandler(reader, None).recv_packet()
+    return asyncio.run(run())
+
+
+def test_stream_close_is_not_dispatched_as_open():
+    close_packet = packets.StreamClosePacket()
+    close_packet.stream_id = 7
+    received = decode(close_packet)
+
+    assert type(received) is packets.StreamClosePacket
+    assert not isinstance(received, packets.StreamOpenPacket)
+
+    open_packet = packets.StreamOpenPacket()
+    open_packet.stream_id = 8
+    received_open = decode(open_packet)
+
+    async def run():
+        multiplexer = Multiplexer(packets.ProtocolHandler(None, None))
+        stream = multiplexer.accept_stream(7)
+        assert multiplexer.handle_packet(received)
+        assert stream.remote_closed
+        assert 7 not in multiplexer.streams
+        assert not multiplexer.handle_packet(received_open)
+    asyncio.run(run())
+
+
+def test_data_past_the_window_resets_the_stream():
+    sent = []
+
+    class Handler(packets.ProtocolHandler):
+        async def send_packet(self, packet, send_header=True):
+            sent.append(packet)
+            return True
+
+    async def run():
+        memory = RelayMemory()
+        multiplexer = Multiplexer(Handler(None, None), memory)
+        stream = multiplexer.accept_stream(1)
+
+        data_packet = packets.StreamDataPacket()
+        data_packet.stream_id = 1
+        data_packet.data = b"x" * MAX_FRAME_SIZE
+        for _ in range(STREAM_WINDOW_SIZE // MAX_FRAME_SIZE):
+            multiplexer.handle_packet(data_packet)
+        assert len(stream.recv_buffer) == STREAM_WINDOW_SIZE
+        assert memory.streams == STREAM_WINDOW_SIZE
+
+        # One frame more than granted
+        multiplexer.handle_packet(data_packet)
+        await stream.wait_closed()
+        assert stream.closed
+        assert multiplexer.stats["window_violations"] == 1
+        assert memory.streams == 0
+        assert 1 not in multiplexer.streams
+        assert isinstance(sent[-1], packets.StreamClosePacket)
+    asyncio.run(run())
+
+
+def test_sequential_connections_release_slots(monkeypatch):
+    # Every visitor closing its stream must give its connection slot back,
+    # more visitors than max_connections one after the other are all served
+    monkeypatch.chdir(REPO_ROOT)
+    from exposehost import client as client_mod
+    from exposehost.impl import tls
+    from exposehost.server import Server
+
+    client_context = tls.create_client_context()
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+    monkeypatch.setattr(client_mod, "ssl_ctx", client_context)
+
+    async def echo(reader, writer):
+        while data := await reader.read(65536):
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    async def run():
+        echo_server = await asyncio.start_server(echo, "127.0.0.1", 0)
+        server = Server("127.0.0.1", 0, use_uvloop=False)
+        await server.startAsync()
+        client = client_mod.Client("127.0.0.1", echo_server.sockets[0].getsockname()[1],
+                                   "127.0.0.1", server.sock4.getsockname()[1], "tcp", "mux-slots",
+                                   max_connections=4, pool_size=0, use_uvloop=False)
+        client_task = asyncio.create_task(client.server_connect())
+        while client.status != "connected":
+            await asyncio.sleep(0.01)
+        forwarder_port = server.clients[0].forwarder_port
+
+        try:
+            for i in range(12):
+                reader, writer = await asyncio.open_connection("127.0.0.1", forwarder_port)
+                payload = b"visitor %d" % i
+                writer.write(payload)
+                await writer.drain()
+                assert await asyncio.wait_for(reader.readexactly(len(payload)), 5) == payload
+                writer.close()
+                await writer.wait_closed()
+
+            # Closes reach the client asynchronously
+            for _ in range(100):
+                if not client.connection_tasks:
+                    break
+                await asyncio.sleep(0.01)
+            assert not client.connection_tasks
+        finally:
+            client_task.cancel()
+            echo_server.close()
+    asyncio.run(run())